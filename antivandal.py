@@ -9,7 +9,8 @@ pan-wikipedia-vandalism-corpus-2010 and pan-wikipedia-vandalism-corpus-2011
 correspondingly.
 
 Here we use MongoDB as an intermediate storage and environment variables
-to configure utils settings.
+to configure utils settings. Set STORAGE_URL to sqlite:///path/to/file.db to
+use the embedded SQLite storage instead (see antivandal_storage).
 
 MongoDB document schema
 -----------------------
@@ -28,6 +29,10 @@ MongoDB document schema
 - oldrevision: old revision content
 - newrevision: new revision content
 
+Revision contents can also be kept apart from edits, in the revision store
+(see `store_revisions`). Then the records have no "oldrevision" and
+"newrevision" fields, and the pipeline loads them by revision ids when needed.
+
 
 [1]: http://www.uni-weimar.de/en/media/chairs/webis/research/corpora/corpus-pan-wvc-10/
 [2]: http://www.uni-weimar.de/en/media/chairs/webis/research/corpora/corpus-pan-wvc-11/
@@ -35,72 +40,234 @@ MongoDB document schema
 from __future__ import division
 import re
 import os
-import nltk
+import sys
+import gc
 import time
-import random
-import pymongo
-import requests
+import hashlib
 import datetime
 import string
-import lzw
+import zlib
 import urllib
-from tqdm import tqdm
-from csv import DictReader, DictWriter
+import json
+import bisect
+import difflib
+import heapq
+import signal
+import resource
+import importlib
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from collections import OrderedDict, Counter, defaultdict
+import csv
+from csv import DictReader
+from antivandal_storage import open_storage, binary_type
+
+
+class LazyModule(object):
+    """
+    Module proxy, importing the module on the first attribute access.
+
+    Heavy dependencies are imported this way to keep the startup of short-lived
+    processes fast
+    """
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def __getattr__(self, attr):
+        module = self.__dict__['_module']
+        if module is None:
+            module = self.__dict__['_module'] = importlib.import_module(self._name)
+        return getattr(module, attr)
+
+
+nltk = LazyModule('nltk')
+requests = LazyModule('requests')
+lzw = LazyModule('lzw')
+np = LazyModule('numpy')
+tqdm_module = LazyModule('tqdm')
+
+
+def tqdm(*args, **kwargs):
+    return tqdm_module.tqdm(*args, **kwargs)
+
 
 # env variables
 MONGODB_URL = os.getenv('MONGODB_URL', 'mongodb://localhost:27017/vandal')
+STORAGE_URL = os.getenv('STORAGE_URL', MONGODB_URL)
 MONGODB_CORPUS_COLLECTION = os.getenv('MONGODB_CORPUS_COLLECTION', 'corpus')
 MONGODB_HTTPCACHE_COLLECTION = os.getenv('MONGODB_HTTPCACHE_COLLECTION', 'httpcache')
 MONGODB_USERS_COLLECTION = os.getenv('MONGODB_USERS_COLLECTION', 'users')
+MONGODB_REVISIONS_COLLECTION = os.getenv('MONGODB_REVISIONS_COLLECTION', 'revisions')
+MONGODB_HISTORY_COLLECTION = os.getenv('MONGODB_HISTORY_COLLECTION', 'history')
+MONGODB_MEMOCACHE_COLLECTION = os.getenv('MONGODB_MEMOCACHE_COLLECTION', 'memocache')
+MONGODB_JOBS_COLLECTION = os.getenv('MONGODB_JOBS_COLLECTION', 'jobs')
+BULK_SIZE = int(os.getenv('ANTIVANDAL_BULK_SIZE', '500'))
+DIFF_MODE = os.getenv('ANTIVANDAL_DIFF_MODE', 'full')  # "full" or "regions"
+COMPRESSOR = os.getenv('ANTIVANDAL_COMPRESSOR', 'zlib')  # "zlib" or "lzw" (slow, compatible with old results)
+WIKIPEDIA_API_URL = os.getenv('WIKIPEDIA_API_URL', 'http://en.wikipedia.org/w/api.php')
+WIKIPEDIA_API_CONCURRENCY = int(os.getenv('WIKIPEDIA_API_CONCURRENCY', '8'))
+WIKIPEDIA_API_RATE_LIMIT = float(os.getenv('WIKIPEDIA_API_RATE_LIMIT', '0'))  # requests per second, 0 for no limit
+REVISION_CACHE_SIZE = int(os.getenv('REVISION_CACHE_SIZE', '2000'))  # revisions kept in memory during import
+HTTPCACHE_SIZE = int(os.getenv('HTTPCACHE_SIZE', '10000'))  # entries kept in memory
+HTTPCACHE_TTL = int(os.getenv('HTTPCACHE_TTL', '0'))  # seconds, 0 for no expiration
+HISTORY_CACHE_SIZE = int(os.getenv('HISTORY_CACHE_SIZE', '1000'))  # article histories kept in memory
+TOKENS_CACHE_SIZE = int(os.getenv('TOKENS_CACHE_SIZE', '2000'))  # token sets of texts kept in memory
+METRICS_CACHE_SIZE = int(os.getenv('METRICS_CACHE_SIZE', '100000'))  # metrics of strings kept in memory
+MEMOCACHE_PERSIST = os.getenv('MEMOCACHE_PERSIST', '0') == '1'  # keep token sets and metrics in the storage
+
+
+storage = None
+
+
+def connect():
+    """
+    Open the storage (MongoDB or SQLite, depending on STORAGE_URL).
 
-# create mongodb connection, database and collection
-conn = pymongo.MongoClient(MONGODB_URL)
-db = conn.get_default_database()
-corpus = db[MONGODB_CORPUS_COLLECTION]
-httpcache = db[MONGODB_HTTPCACHE_COLLECTION]
-users = db[MONGODB_USERS_COLLECTION]
+    Called on the first use of any collection, and in every worker process of
+    the parallel `apply`, as connections must not be shared across fork()
+    """
+    global storage
+    storage = open_storage(STORAGE_URL)
+
+
+def get_storage():
+    if storage is None:
+        connect()
+    return storage
+
+
+class LazyCollection(object):
+    """
+    Proxy of the storage collection, resolved on the first use (and again
+    after reconnect)
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._storage = None
+        self._collection = None
+
+    def __getattr__(self, attr):
+        current_storage = get_storage()
+        if self._storage is not current_storage:
+            self._collection = current_storage.collection(self._name)
+            self._storage = current_storage
+        return getattr(self._collection, attr)
+
+
+corpus = LazyCollection(MONGODB_CORPUS_COLLECTION)
+httpcache = LazyCollection(MONGODB_HTTPCACHE_COLLECTION)
+users = LazyCollection(MONGODB_USERS_COLLECTION)
+revisions = LazyCollection(MONGODB_REVISIONS_COLLECTION)
+history = LazyCollection(MONGODB_HISTORY_COLLECTION)
+memocache = LazyCollection(MONGODB_MEMOCACHE_COLLECTION)
+jobs = LazyCollection(MONGODB_JOBS_COLLECTION)
 
 # misc constants
 re_ip = re.compile(r'^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}$')
 re_http_url = re.compile(r'\bhttps?://[\w/%?#&_\-=.,]+[\w/%?#&_\-](?=[\'<>.,]?)')
 magic = 'lskmqs'
+re_url_placeholder = re.compile(magic + '[a-z]{16}')
 
 def ensure_index():
     """
-    Ensure MongoDB database has indexes
+    Ensure the storage has indexes
     """
-    corpus.ensure_index([('ds', pymongo.ASCENDING), ('editid', pymongo.ASCENDING)],
+    corpus.ensure_index([('ds', 1), ('editid', 1)],
                         unique=True, name='unique_id')
-    corpus.ensure_index([('vanalism', pymongo.ASCENDING)], name='vandalism')
-    httpcache.ensure_index([('key', pymongo.ASCENDING)], name='cache_key')
-    users.ensure_index([('name', pymongo.ASCENDING)], name='name')
+    corpus.ensure_index([('vanalism', 1)], name='vandalism')
+    httpcache.ensure_index([('key', 1)], name='cache_key')
+    users.ensure_index([('name', 1)], name='name')
+    revisions.ensure_index([('sha1', 1)], name='sha1')
+    revisions.ensure_index([('articleid', 1), ('_id', 1)],
+                           name='article_revisions')
+    history.ensure_index([('articleid', 1), ('_id', 1)],
+                         name='article_history')
+    memocache.ensure_index([('key', 1)], name='memo_key')
+    jobs.ensure_index([('job', 1), ('state', 1)], name='job_state')
+
+
+class BulkWriter(object):
+    """
+    Write buffer which groups upserts and partial updates of the collection
+    into unordered bulk operations of `batch_size` items.
 
+    Use it as a context manager to make sure the tail of the buffer is flushed
+    """
 
-def import_corpus_2010():
+    def __init__(self, collection, batch_size=None, stats=None):
+        self.collection = collection
+        self.batch_size = batch_size or BULK_SIZE
+        self.stats = stats
+        self.ops = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.flush()
+
+    def upsert(self, spec, doc):
+        """
+        Replace the document matching `spec` with `doc`, or insert a new one
+        """
+        self.ops.append((spec, doc, True))
+        self._maybe_flush()
+
+    def update(self, spec, update):
+        """
+        Apply update document (with $set and $unset operators) to the
+        document matching `spec`
+        """
+        self.ops.append((spec, update, False))
+        self._maybe_flush()
+
+    def flush(self):
+        if not self.ops:
+            return
+        start = time.time()
+        bulk = self.collection.initialize_unordered_bulk_op()
+        for spec, doc, upsert in self.ops:
+            if upsert:
+                bulk.find(spec).upsert().replace_one(doc)
+            else:
+                bulk.find(spec).update_one(doc)
+        bulk.execute()
+        if self.stats is not None:
+            self.stats.add_write(len(self.ops), time.time() - start)
+        self.ops = []
+
+    def _maybe_flush(self):
+        if len(self.ops) >= self.batch_size:
+            self.flush()
+
+
+def import_corpus_2010(**kwargs):
     """
-    Import 2010 data to MongoDB
+    Import 2010 data to MongoDB. See `import_corpus` for keyword arguments
     """
-    edits = list(DictReader(open('pan-wikipedia-vandalism-corpus-2010/edits.csv')))
-    gold_annotations = list(DictReader(open('pan-wikipedia-vandalism-corpus-2010/gold-annotations.csv')))
-    vandalism_ids = {int(a['editid']) for a in gold_annotations if a['class'] == 'vandalism'}
-    revision_filenames = get_revision_filenames_2010()
-    for edit in tqdm(edits):
+    with open('pan-wikipedia-vandalism-corpus-2010/gold-annotations.csv') as fd:
+        vandalism_ids = {int(a['editid']) for a in DictReader(fd) if a['class'] == 'vandalism'}
+
+    def prepare_edit(edit):
         edit = to_int(edit, 'articleid', 'editid', 'newrevisionid', 'oldrevisionid')
         edit = to_timestamp(edit, 'edittime')
         edit.update(ds=2010, vandalism=edit['editid'] in vandalism_ids)
-        edit['oldrevision'] = open(revision_filenames[edit['oldrevisionid']]).read()
-        edit['newrevision'] = open(revision_filenames[edit['newrevisionid']]).read()
-        spec = dict(ds=2010, editid=edit['editid'])
-        corpus.update(spec, edit, upsert=True)
+        return edit
+
+    import_corpus(2010, 'pan-wikipedia-vandalism-corpus-2010/edits.csv',
+                  get_revision_filenames_2010(), prepare_edit, **kwargs)
 
 
-def import_corpus_2011():
+def import_corpus_2011(**kwargs):
     """
-    Import 2011 data to MongoDB
+    Import 2011 data to MongoDB. See `import_corpus` for keyword arguments
     """
-    edits = list(DictReader(open('pan-wikipedia-vandalism-corpus-2011/edits-en.csv')))
-    revision_filenames = get_revision_filenames_2011()
-    for edit in tqdm(edits):
+    def prepare_edit(edit):
         del edit['annotators']
         del edit['totalannotators']
         edit_class = edit.pop('class')
@@ -108,10 +275,82 @@ def import_corpus_2011():
         edit['ds'] = 2011
         edit = to_int(edit, 'articleid', 'editid', 'newrevisionid', 'oldrevisionid')
         edit = to_timestamp(edit, 'edittime')
-        edit['oldrevision'] = open(revision_filenames[edit['oldrevisionid']]).read()
-        edit['newrevision'] = open(revision_filenames[edit['newrevisionid']]).read()
-        spec = dict(ds=2011, editid=edit['editid'])
-        corpus.update(spec, edit, upsert=True)
+        return edit
+
+    import_corpus(2011, 'pan-wikipedia-vandalism-corpus-2011/edits-en.csv',
+                  get_revision_filenames_2011(), prepare_edit, **kwargs)
+
+
+def import_corpus(ds, edits_filename, revision_filenames, prepare_edit, threads=8,
+                  chunk_size=200, resume=True, batch_size=None, embed_revisions=True,
+                  delta=False):
+    """
+    Stream edits from the csv file to MongoDB.
+
+    Edits are read lazily by chunks. Revision files of every chunk are read
+    in the thread pool, and kept in the LRU cache of REVISION_CACHE_SIZE
+    revisions, so that a revision shared by several edits is usually read
+    once.
+
+    :param prepare_edit: function converting the csv row to the record
+    :param resume: skip edits already imported, which makes it possible to
+                   resume the interrupted import
+    :param embed_revisions: if False, revision contents are saved to the
+                            revision store instead of the edit records
+    :param delta: delta-encode revisions in the revision store (see
+                  `store_revisions`)
+    """
+    done = set(corpus.find({'ds': ds}, fields=['editid']).distinct('editid')) if resume else set()
+    revision_cache = LRUCache(REVISION_CACHE_SIZE)
+    pool = ThreadPool(threads)
+
+    try:
+        with open(edits_filename) as fd, BulkWriter(corpus, batch_size) as writer:
+            edits = (prepare_edit(edit) for edit in DictReader(fd))
+            edits = (edit for edit in edits if edit['editid'] not in done)
+            progress = tqdm()
+            for chunk in iter_chunks(edits, chunk_size):
+                chunk_revisions = {}
+                for edit in chunk:
+                    for k in ('oldrevisionid', 'newrevisionid'):
+                        if edit[k] not in chunk_revisions:
+                            chunk_revisions[edit[k]] = revision_cache.get(edit[k])
+                missing = sorted(revid for revid, text in chunk_revisions.iteritems() if text is None)
+                texts = pool.map(read_revision, [revision_filenames[revid] for revid in missing])
+                for revid, text in zip(missing, texts):
+                    chunk_revisions[revid] = text
+                    revision_cache.set(revid, text)
+
+                if not embed_revisions:
+                    articles = {}
+                    for edit in chunk:
+                        articles[edit['oldrevisionid']] = edit['articleid']
+                        articles[edit['newrevisionid']] = edit['articleid']
+                    store_revisions([(revid, articles[revid], text)
+                                     for revid, text in chunk_revisions.iteritems()],
+                                    delta=delta, batch_size=batch_size)
+
+                for edit in chunk:
+                    if embed_revisions:
+                        edit['oldrevision'] = chunk_revisions[edit['oldrevisionid']]
+                        edit['newrevision'] = chunk_revisions[edit['newrevisionid']]
+                    spec = dict(ds=ds, editid=edit['editid'])
+                    writer.upsert(spec, edit)
+                progress.update(len(chunk))
+            progress.close()
+    finally:
+        pool.close()
+        pool.join()
+
+
+def read_revision(filename):
+    """
+    Read the content of the revision file. The text is stored in the corpus
+    as a whole, so it's read in one call (mapping the file would only add a
+    copy of the mapping)
+    """
+    with open(filename, 'rb') as fd:
+        return fd.read()
 
 
 def get_revision_filenames_2010():
@@ -122,10 +361,17 @@ def get_revision_filenames_2011():
     return get_revision_filenames('pan-wikipedia-vandalism-corpus-2011/article-revisions-en')
 
 
+revision_filenames_cache = {}
+
+
 def get_revision_filenames(topdir):
     """
     Helper function returning a dict: {revision_id: path/to/file.txt}
+
+    The directory is scanned once per process
     """
+    if topdir in revision_filenames_cache:
+        return revision_filenames_cache[topdir]
     result = {}
     for dirname, dirs, files in os.walk(topdir):
         if dirname == topdir:
@@ -133,27 +379,216 @@ def get_revision_filenames(topdir):
         for filename in files:
             revid = int(filename.split('.')[0])
             result[revid] = os.path.join(dirname, filename)
+    revision_filenames_cache[topdir] = result
     return result
 
 
+#--- Revision store
+
+# revision content fields of the record, and the fields with their ids
+revision_fields = {'oldrevision': 'oldrevisionid', 'newrevision': 'newrevisionid'}
+
+
+def store_revisions(items, delta=False, max_chain=16, batch_size=None):
+    """
+    Save revisions to the revision store, skipping the ones already stored.
+
+    Documents of the store are keyed by revision id. Content is stored as a
+    zlib-compressed blob, or as a reference to the revision with the same
+    content (by SHA-1), or, if `delta` is True, as a compressed line delta
+    against the previous stored revision of the same article. Delta chains
+    are limited to `max_chain` revisions.
+
+    Stored revisions, duplicates and delta bases of all items are looked up
+    at once, texts of the items are reused as delta bases, and the documents
+    are written in bulk operations of `batch_size`.
+
+    :param items: list of (revision id, article id, text) tuples
+    """
+    items = sorted(items)
+    texts = {revid: to_utf8(text) for revid, _, text in items}
+    stored = {doc['_id'] for doc in revisions.find({'_id': {'$in': sorted(texts)}}, fields=['_id'])}
+    items = [item for item in items if item[0] not in stored]
+    if not items:
+        return
+
+    sha1s = {revid: hashlib.sha1(texts[revid]).hexdigest() for revid, _, _ in items}
+    spec = {'sha1': {'$in': sorted(set(sha1s.values()))}}
+    same_docs = {}
+    for doc in revisions.find(spec, fields=['_id', 'sha1', 'depth']):
+        same_docs.setdefault(doc['sha1'], doc)
+    # sorted (revision id, depth) of every article, to find the delta bases
+    article_revisions = defaultdict(list)
+    if delta:
+        spec = {'articleid': {'$in': sorted({articleid for _, articleid, _ in items})}}
+        for doc in revisions.find(spec, fields=['_id', 'articleid', 'depth']):
+            article_revisions[doc['articleid']].append((doc['_id'], doc['depth']))
+        for article in article_revisions.itervalues():
+            article.sort()
+
+    docs = []
+    for revid, articleid, _ in items:
+        doc = {'_id': revid, 'articleid': articleid, 'sha1': sha1s[revid],
+               'size': len(texts[revid]), 'depth': 0}
+        same = same_docs.get(doc['sha1'])
+        base = None
+        if delta and not same:
+            article = article_revisions[articleid]
+            i = bisect.bisect_left(article, (revid,))
+            base = article[i - 1] if i else None
+        if same:
+            doc.update(same_as=same['_id'], depth=same['depth'] + 1)
+        elif base and base[1] < max_chain:
+            doc.update(base=base[0], depth=base[1] + 1)
+        same_docs.setdefault(doc['sha1'], doc)
+        if delta:
+            bisect.insort(article_revisions[articleid], (revid, doc['depth']))
+        docs.append(doc)
+
+    # texts of the bases stored before, the other ones are items
+    base_ids = {doc['base'] for doc in docs if 'base' in doc} - set(texts)
+    texts.update((revid, to_utf8(text)) for revid, text in load_revisions(base_ids).iteritems())
+    with BulkWriter(revisions, batch_size) as writer:
+        for doc in docs:
+            data = texts[doc['_id']]
+            if 'base' in doc:
+                ops = encode_delta(texts[doc['base']], data)
+                doc['delta'] = binary_type()(zlib.compress(json.dumps(ops)))
+            elif 'same_as' not in doc:
+                doc['blob'] = binary_type()(zlib.compress(data))
+            writer.upsert({'_id': doc['_id']}, doc)
+
+
+def load_revisions(revids):
+    """
+    Load revision contents from the revision store. Return the dict
+    {revision id: text}, missing revisions are omitted
+    """
+    docs = {}
+    pending = set(revids)
+    while pending:
+        fetched = list(revisions.find({'_id': {'$in': sorted(pending)}}))
+        docs.update((doc['_id'], doc) for doc in fetched)
+        # fetch revisions the fetched documents depend on
+        pending = {doc.get('same_as', doc.get('base')) for doc in fetched} - set(docs) - {None}
+
+    texts = {}
+    def _load(revid):
+        if revid not in texts:
+            doc = docs[revid]
+            if 'same_as' in doc:
+                texts[revid] = _load(doc['same_as'])
+            elif 'base' in doc:
+                ops = json.loads(zlib.decompress(doc['delta']))
+                texts[revid] = decode_delta(to_utf8(_load(doc['base'])), ops).decode('utf8')
+            else:
+                texts[revid] = zlib.decompress(doc['blob']).decode('utf8')
+        return texts[revid]
+
+    return {revid: _load(revid) for revid in revids if revid in docs}
+
+
+def encode_delta(base, data):
+    """
+    Line delta of data against base: the list of [i1, i2] (copy lines i1:i2
+    of base) and strings (insert the string)
+    """
+    base_lines = base.splitlines(True)
+    lines = data.splitlines(True)
+    ops = []
+    matcher = difflib.SequenceMatcher(None, base_lines, lines, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append([i1, i2])
+        elif j1 < j2:
+            ops.append(''.join(lines[j1:j2]).decode('utf8'))
+    return ops
+
+
+def decode_delta(base, ops):
+    base_lines = base.splitlines(True)
+    chunks = []
+    for op in ops:
+        if isinstance(op, list):
+            chunks.extend(base_lines[op[0]:op[1]])
+        else:
+            chunks.append(op.encode('utf8'))
+    return ''.join(chunks)
+
+
+def to_utf8(text):
+    if isinstance(text, unicode):
+        return text.encode('utf8')
+    return text
+
+
+def load_record_revisions(records):
+    """
+    Fill "oldrevision" and "newrevision" fields of the records fetched
+    without them, from the revision store or, if revisions are embedded, from
+    the corpus. Return the list of (record, field) tuples which were filled
+    """
+    missing = [(record, field) for record in records for field in revision_fields
+               if field not in record]
+    if not missing:
+        return []
+
+    texts = load_revisions({record[revision_fields[field]] for record, field in missing})
+    embedded_ids = set()
+    for record, field in missing:
+        revid = record[revision_fields[field]]
+        if revid in texts:
+            record[field] = texts[revid]
+        else:
+            embedded_ids.add(record['_id'])
+
+    if embedded_ids:
+        cursor = corpus.find({'_id': {'$in': list(embedded_ids)}}, fields=list(revision_fields))
+        embedded = {doc['_id']: doc for doc in cursor}
+        for record, field in missing:
+            if field not in record:
+                record[field] = embedded[record['_id']][field]
+    return missing
+
+
+def migrate_revisions(delta=False, chunk_size=200):
+    """
+    Move revision contents embedded in corpus records to the revision store
+    """
+    spec = {'oldrevision': {'$exists': True}}
+    fields = ['articleid', 'oldrevisionid', 'newrevisionid', 'oldrevision', 'newrevision']
+    progress = tqdm(total=corpus.find(spec).count())
+    with BulkWriter(corpus) as writer:
+        for records in iter_chunks(corpus.find(spec, fields=fields), chunk_size):
+            items = {}
+            for record in records:
+                for field, id_field in revision_fields.iteritems():
+                    items[record[id_field]] = (record[id_field], record['articleid'], record[field])
+            store_revisions(items.values(), delta=delta)
+            for record in records:
+                writer.update({'_id': record['_id']},
+                              {'$unset': {'oldrevision': '', 'newrevision': ''}})
+            progress.update(len(records))
+    progress.close()
+
+
 #--- Dumper
 
 
-def export_collection(filename, collection=corpus, include=None, exclude=None, converters=None, default_values=None):
+def export_collection(filename, collection=corpus, include=None, exclude=None, converters=None,
+                      default_values=None, spec=None):
     """
     Export corpus to a csv file
 
     :param exclude: list of fields to exclude. By default we exclude
                     "oldrevision" and "newrevision" records
+    :param spec: query spec selecting the exported records, all by default
     """
-    converters = converters or {}
-    default_values = default_values or {}
-    all_fields = set(collection.find_one().keys())
+    all_fields = set(collection.find_one(spec).keys())
 
     if include is not None:
         # handle include parameter
         returned_fields = include
-        fields_dict = {f: False for f in all_fields if f not in include}
 
     else:
         # handle exclude parameter
@@ -163,117 +598,1487 @@ def export_collection(filename, collection=corpus, include=None, exclude=None, c
         exclude.add('_id')
 
         returned_fields = sorted(all_fields - exclude)
-        fields_dict = {f: False for f in exclude}
-
-    with open(filename, mode='w') as fd:
-        writer = DictWriter(fd, returned_fields)
-        writer.writeheader()
-        for record in tqdm(collection.find(fields=fields_dict), total=collection.count()):
-            out = {}
-            for k in returned_fields:
-                v = record.get(k, default_values.get(k))
+
+    export_collections([(filename, returned_fields)], collection=collection,
+                       converters=converters, default_values=default_values, spec=spec)
+
+
+def export_collections(outputs, collection=corpus, converters=None, default_values=None,
+                       chunk_size=10000, spec=None):
+    """
+    Export the collection to several files in a single pass of the cursor.
+
+    Records are converted to columns in chunks of `chunk_size` records, and
+    every chunk is appended to all outputs.
+
+    :param outputs: list of (filename, list of fields) tuples. The format of
+                    the file is defined by its extension: ".csv" or ".parquet"
+                    (requires pyarrow)
+    :param spec: query spec selecting the exported records, all by default
+    """
+    converters = converters or {}
+    default_values = default_values or {}
+    fields = sorted({f for _, output_fields in outputs for f in output_fields})
+    writers = [get_table_writer(filename, output_fields) for filename, output_fields in outputs]
+
+    try:
+        cursor = collection.find(spec, fields=fields)
+        progress = tqdm(total=cursor.count())
+        for records in iter_chunks(cursor, chunk_size):
+            columns = {}
+            for k in fields:
+                default = default_values.get(k)
+                column = [record.get(k, default) for record in records]
                 if k in converters:
-                    v = converters[k](v)
-                if isinstance(v, unicode):
-                    v = v.encode('utf8')
-                if isinstance(v, bool):
-                    v = int(v)
-                out[k] = v
-            writer.writerow(out)
+                    column = map(converters[k], column)
+                columns[k] = column
+            for writer in writers:
+                writer.write(columns)
+            progress.update(len(records))
+        progress.close()
+    finally:
+        for writer in writers:
+            writer.close()
+
+
+def get_table_writer(filename, fields):
+    if filename.endswith('.csv'):
+        return CsvTableWriter(filename, fields)
+    if filename.endswith('.parquet'):
+        return ParquetTableWriter(filename, fields)
+    raise ValueError('Unknown file format: %s' % filename)
+
+
+class CsvTableWriter(object):
+    """
+    Append chunks of columns to a csv file. The header is written even if
+    there are no rows. Unicode strings are encoded to utf8, and booleans are
+    written as 0 / 1
+    """
+
+    def __init__(self, filename, fields):
+        self.fields = list(fields)
+        self.fd = open(filename, mode='w')
+        self.writer = csv.writer(self.fd)
+        self.writer.writerow(self.fields)
+
+    def write(self, columns):
+        self.writer.writerows(zip(*[map(to_csv_value, columns[k]) for k in self.fields]))
+
+    def close(self):
+        self.fd.close()
+
+
+def to_csv_value(v):
+    if isinstance(v, unicode):
+        return v.encode('utf8')
+    if isinstance(v, bool):
+        return int(v)
+    return v
+
+
+class ParquetTableWriter(object):
+    """
+    Append chunks of columns to a parquet file as row groups.
+
+    Column types are inferred from the chunks and only get wider (see
+    `get_wider_arrow_type`). When a chunk needs a wider type than the previous
+    ones, e.g. a column which was all null so far, or integers followed by
+    floats, the row groups written so far are left in a temporary file, and
+    they are converted to the final schema on `close`
+    """
+
+    def __init__(self, filename, fields):
+        self.filename = filename
+        self.fields = list(fields)
+        self.schema = None
+        self.writer = None
+        self.parts = []
+
+    def write(self, columns):
+        import pyarrow.parquet
+        table = to_arrow_table(columns, self.fields, self.schema)
+        if self.writer is None or not table.schema.equals(self.schema):
+            if self.writer is not None:
+                self.writer.close()
+            self.schema = table.schema
+            self.parts.append('%s.tmp-%d' % (self.filename, len(self.parts)))
+            self.writer = pyarrow.parquet.ParquetWriter(self.parts[-1], self.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        import pyarrow.parquet
+        if self.writer is None:
+            # no rows: all columns have null type
+            self.write({k: [] for k in self.fields})
+        self.writer.close()
+        if len(self.parts) == 1:
+            os.rename(self.parts[0], self.filename)
+            return
+        writer = pyarrow.parquet.ParquetWriter(self.filename, self.schema)
+        try:
+            for part in self.parts:
+                parquet_file = pyarrow.parquet.ParquetFile(part)
+                for i in xrange(parquet_file.num_row_groups):
+                    writer.write_table(parquet_file.read_row_group(i).cast(self.schema))
+        finally:
+            writer.close()
+        for part in self.parts:
+            os.remove(part)
+
+
+def to_arrow_table(columns, fields, schema=None):
+    """
+    Convert chunk of columns to pyarrow.Table. Column types are inferred from
+    the chunk and widened to the types of `schema` (of the previous chunks),
+    so the schema of the table is the same as `schema` unless some column
+    needs a wider type
+    """
+    import pyarrow
+    arrays = []
+    for i, k in enumerate(fields):
+        array = pyarrow.array(columns[k])
+        if schema is not None:
+            wider_type = get_wider_arrow_type(schema.types[i], array.type)
+            if wider_type != array.type:
+                array = pyarrow.array(columns[k], type=wider_type)
+        arrays.append(array)
+    return pyarrow.Table.from_arrays(arrays, names=list(fields))
+
+
+def get_wider_arrow_type(a, b):
+    """
+    Return the type which can hold the values of both pyarrow types: null
+    columns take the type of the other one, and integers are widened to
+    int64, or to float64 if the other column is floating point.
+    Raises ValueError for other types which differ
+    """
+    import pyarrow
+    import pyarrow.types
+    if a == b or pyarrow.types.is_null(b):
+        return a
+    if pyarrow.types.is_null(a):
+        return b
+    numeric = [pyarrow.types.is_integer(t) or pyarrow.types.is_floating(t) for t in (a, b)]
+    if all(numeric):
+        if pyarrow.types.is_integer(a) and pyarrow.types.is_integer(b):
+            return pyarrow.int64()
+        return pyarrow.float64()
+    raise ValueError('Incompatible column types: %s and %s' % (a, b))
 
 
 #--- Dataset extension functions
 
-def apply_all():
-    apply(cleanup, extend_with_diff, extend_with_basic_text_metrics, extend_with_ratio_metrics)
+def apply_all(**kwargs):
+    """
+    Run the pipeline over the corpus, recomputing only the stages whose
+    inputs or version changed since the previous run. Return the
+    `PipelineStats` if instrumented (see `apply`)
+    """
+    return apply(*pipeline, incremental=True, **kwargs)
 
 
-def apply(*functions):
+def apply(*functions, **kwargs):
     """
     A function which applies the sequence of functions `func` to every item of
     the MongoDB-stored dataset. If function returns a dict, it's merged back
     with the item and we update the record
+
+    :param processes: number of worker processes. By default (None or 1) all
+                      records are processed in the current process. Otherwise
+                      the collection is split to `_id` ranges which are
+                      processed by the pool of workers, and the results are
+                      written back by the parent process.
+    :param chunk_size: number of records processed at once (and the number
+                       of records in a single `_id` range in parallel mode)
+    :param batch_size: number of updates sent to MongoDB in a single bulk
+                       operation
+    :param incremental: skip the stages (functions decorated with `stage`)
+                        whose fingerprint stored in the record matches the
+                        fingerprint of their current inputs and version
+    :param instrument: collect `PipelineStats` (timing of every function,
+                       bytes processed, writes, slowest records), print the
+                       report at the end of the run and return the stats
+    :param callbacks: list of functions `callback(event, stats)` called with
+                      events "chunk" (stats of the processed chunk), "write"
+                      (stats of the run so far, after every bulk write) and
+                      "finish" (stats of the whole run). Implies `instrument`
+    :param profile: run the sampling profiler in the processes applying the
+                    functions, see `PipelineStats.save_profile`. Implies
+                    `instrument`
+    :param spec: query spec selecting the records to process, all records by
+                 default (see antivandal_jobs for processing the corpus by
+                 shards)
+
+    Only the fields declared by the functions with the `uses_fields` decorator
+    are fetched from the database (the whole record is fetched if any of the
+    functions doesn't declare its fields), and only the changed fields are
+    written back with $set / $unset.
     """
-    for record in tqdm(corpus.find(), total=corpus.count()):
+    processes = kwargs.pop('processes', None)
+    chunk_size = kwargs.pop('chunk_size', 1000)
+    batch_size = kwargs.pop('batch_size', None)
+    incremental = kwargs.pop('incremental', False)
+    callbacks = kwargs.pop('callbacks', None)
+    profile = kwargs.pop('profile', False)
+    instrument = kwargs.pop('instrument', False) or bool(callbacks) or profile
+    spec = kwargs.pop('spec', None)
+    if kwargs:
+        raise TypeError('Unexpected keyword arguments: %s' % ', '.join(kwargs))
+
+    stats = PipelineStats(callbacks) if instrument else None
+    with BulkWriter(corpus, batch_size, stats) as writer:
+
+        if not processes or processes == 1:
+            cursor = corpus.find(spec, fields=get_projection(functions, instrument))
+            progress = tqdm(total=cursor.count())
+            sampler = Sampler().start() if profile else None
+            try:
+                chunks = iter_chunks(cursor, chunk_size)
+                while True:
+                    start = time.time()
+                    records = next(chunks, None)
+                    if records is None:
+                        break
+                    chunk_stats = None
+                    if instrument:
+                        chunk_stats = PipelineStats()
+                        chunk_stats.add_stage('read', [time.time() - start], len(records))
+                        counters = get_memo_counters()
+                    for _id, update in apply_to_records(records, functions, incremental, chunk_stats):
+                        writer.update({'_id': _id}, update)
+                    if instrument:
+                        chunk_stats.add_cache_counters(counters)
+                        stats.add_chunk(chunk_stats)
+                    progress.update(len(records))
+            finally:
+                if sampler is not None:
+                    stats.samples.update(sampler.stop())
+            progress.close()
 
-        orig_record = record.copy()
+        else:
+            tasks = [(functions, incremental, spec, lo, hi, instrument, profile)
+                     for lo, hi in get_id_ranges(chunk_size, spec)]
+            pool = multiprocessing.Pool(processes, initializer=connect)
+            try:
+                progress = tqdm(total=corpus.find(spec).count())
+                for updates, processed, chunk_stats in pool.imap_unordered(apply_to_range, tasks):
+                    for _id, update in updates:
+                        writer.update({'_id': _id}, update)
+                    if instrument:
+                        stats.add_chunk(chunk_stats)
+                    progress.update(processed)
+                progress.close()
+            finally:
+                pool.close()
+                pool.join()
+
+    if instrument:
+        stats.emit('finish', stats)
+        print stats.report()
+        return stats
+
+
+def uses_fields(*fields):
+    """
+    Decorator declaring the record fields the extension function reads. If
+    all functions passed to `apply` declare their fields, the records are
+    fetched with the projection
+    """
+    def decorator(func):
+        func.fields = fields
+        return func
+    return decorator
 
-        for func in functions:
-            ret = func(**record)
-            overwrite = False
 
+def stage(inputs, outputs, version=1, key=None, removes=()):
+    """
+    Decorator registering the extension function as a stage of the
+    incremental pipeline.
+
+    :param inputs: record fields the function reads
+    :param outputs: record fields the function writes
+    :param version: version of the function. Bump it every time the function
+                    starts returning different results for the same inputs
+    :param key: name of the stage fingerprint in the record, the name of the
+                function by default. Alternative implementations of the same
+                stage share the key (and differ in version), so that
+                switching between them recomputes the stage
+    :param removes: record fields the stage removes, e.g. outputs of the
+                    alternative implementations
+    """
+    def decorator(func):
+        func.fields = tuple(inputs)
+        func.outputs = tuple(outputs)
+        func.version = version
+        func.key = key or func.__name__
+        func.removes = tuple(removes)
+        return func
+    return decorator
+
+
+def batched(func):
+    """
+    Decorator registering the function as the batch implementation of the
+    extension function `func`. The batch implementation accepts the list of
+    records and returns the list of dicts, and `apply` uses it instead of
+    calling `func` for every record.
+    """
+    def decorator(batch_func):
+        func.batch = batch_func
+        return batch_func
+    return decorator
+
+
+def columnar(func):
+    """
+    Decorator registering the function as the columnar implementation of the
+    extension function `func`. The columnar implementation accepts the
+    `EditBatch` and the list of row indices, and writes the outputs to the
+    batch with `EditBatch.set_values`. `apply` prefers it to the batch
+    implementation.
+    """
+    def decorator(columnar_func):
+        func.columnar = columnar_func
+        return columnar_func
+    return decorator
+
+
+def get_fingerprints(func, batch, idx):
+    """
+    Return the list of fingerprints of the stage for the rows `idx` of the
+    `EditBatch`: hashes of the stage version and the values of its inputs
+    """
+    hashes = [hashlib.md5(repr(func.version)) for _ in idx]
+    for field in func.fields:
+        # revision contents never change, so their ids are hashed instead
+        field = revision_fields.get(field, field)
+        for h, value in zip(hashes, batch.get_values(field, idx)):
+            h.update(repr(value))
+    return [h.hexdigest() for h in hashes]
+
+
+def get_projection(functions, instrument=False):
+    """
+    Return the list of fields required by the sequence of functions, or None
+    if the whole record has to be fetched.
+
+    Revision contents are never included: ids of revisions are fetched
+    instead, and contents are loaded only for the records and stages which
+    need them (see `load_record_revisions`).
+
+    If `instrument` is True, editid is fetched to identify the slowest records
+    """
+    fields = {'editid'} if instrument else set()
+    for func in functions:
+        if getattr(func, 'fields', None) is None:
+            return None
+        fields.update(revision_fields.get(f, f) for f in func.fields)
+        if hasattr(func, 'version'):
+            # outputs are fetched to write back only the changed ones
+            fields.update(func.outputs)
+            fields.update(func.removes)
+            fields.add('fingerprints')
+    return sorted(fields)
+
+
+#--- Edit batches
+
+# marker of the absent field
+absent = object()
+
+
+class Column(object):
+    """
+    Typed column of int, float or bool values: numpy array of values and the
+    array of row states (absent field, None, value)
+    """
+    __slots__ = ['pytype', 'values', 'states']
+
+    ABSENT, NONE, VALUE = 0, 1, 2
+    dtypes = {bool: 'bool', int: 'int64', float: 'float64'}
+
+    def __init__(self, size, pytype):
+        self.pytype = pytype
+        self.values = np.zeros(size, dtype=self.dtypes[pytype])
+        self.states = np.zeros(size, dtype=np.int8)
+
+    def accepts(self, value):
+        return value is None or value is absent or type(value) is self.pytype
+
+    def get(self, i, default=None):
+        state = self.states[i]
+        if state == self.VALUE:
+            return self.values[i].item()
+        if state == self.NONE:
+            return None
+        return default
+
+    def set(self, i, value):
+        if value is absent:
+            self.states[i] = self.ABSENT
+        elif value is None:
+            self.states[i] = self.NONE
+        else:
+            self.values[i] = value
+            self.states[i] = self.VALUE
+
+    def tolist(self):
+        return [self.get(i, absent) for i in xrange(len(self.states))]
+
+    def get_values(self, idx, default=None):
+        values = self.values.tolist()
+        states = self.states.tolist()
+        return [values[i] if states[i] == self.VALUE else None if states[i] == self.NONE else default
+                for i in idx]
+
+
+def make_column(values, value=absent):
+    """
+    Return the writable column with the values (list with `absent` markers),
+    typed if all of them (and the value to write) are of the same numeric type
+    """
+    types = {type(v) for v in values if v is not absent and v is not None}
+    if value is not absent and value is not None:
+        types.add(type(value))
+    if len(types) != 1 or next(iter(types)) not in Column.dtypes:
+        return list(values)
+    column = Column(len(values), types.pop())
+    column.states[:] = [Column.ABSENT if v is absent else Column.NONE if v is None else Column.VALUE
+                        for v in values]
+    column.values[:] = [0 if v is absent or v is None else v for v in values]
+    return column
+
+
+class EditBatch(object):
+    """
+    Columnar representation of the list of records processed together.
+
+    Every field is a column: the list of values, shared with the source
+    records until it's written, or the typed numpy `Column` for numeric
+    stage outputs. Source values (including revision texts) are held by
+    reference and never copied, and changes are detected by comparing only the
+    written columns.
+    """
+    __slots__ = ['size', 'ids', 'columns', 'original', 'written']
+
+    def __init__(self, records):
+        self.size = len(records)
+        self.ids = [record['_id'] for record in records]
+        self.columns = {}
+        for i, record in enumerate(records):
+            for field, value in record.iteritems():
+                column = self.columns.get(field)
+                if column is None:
+                    column = self.columns[field] = [absent] * self.size
+                column[i] = value
+        self.original = dict(self.columns)
+        self.written = set()
+
+    def row(self, i):
+        return EditRow(self, i)
+
+    def get(self, i, field, default=None):
+        column = self.columns.get(field)
+        if column is None:
+            return default
+        if type(column) is Column:
+            return column.get(i, default)
+        value = column[i]
+        return default if value is absent else value
+
+    def get_values(self, field, idx):
+        """
+        Return the list of values of the field in the rows (None if absent)
+        """
+        column = self.columns.get(field)
+        if column is None:
+            return [None] * len(idx)
+        if type(column) is Column:
+            return column.get_values(idx)
+        return [None if column[i] is absent else column[i] for i in idx]
+
+    def fields(self, i):
+        return [field for field in self.columns if self.get(i, field, absent) is not absent]
+
+    def set_value(self, i, field, value):
+        """
+        Set the value of the field in the row (`absent` removes the field)
+        """
+        column = self.columns.get(field)
+        if column is not None and type(column) is not Column:
+            current = column[i]
+            if current is value:
+                return
+        if column is None:
+            if value is absent:
+                return
+            column = self.columns[field] = make_column([absent] * self.size, value)
+        elif column is self.original.get(field):
+            column = self.columns[field] = make_column(column, value)
+        self.written.add(field)
+        if type(column) is Column:
+            if column.accepts(value):
+                column.set(i, value)
+                return
+            column = self.columns[field] = column.tolist()
+        column[i] = value
+
+    def set_values(self, field, idx, values):
+        column = self.columns.get(field)
+        if column is not None and column is not self.original.get(field):
+            for i, value in zip(idx, values):
+                self.set_value(i, field, value)
+            return
+        # the first write of the field builds the whole column at once
+        changed = [(i, value) for i, value in zip(idx, values)
+                   if value is not (absent if column is None else column[i])]
+        if not changed:
+            return
+        column = [absent] * self.size if column is None else list(column)
+        for i, value in changed:
+            column[i] = value
+        self.columns[field] = make_column(column)
+        self.written.add(field)
+
+    def update(self, i, ret, overwrite=False):
+        """
+        Write the dict returned by the extension function to the row. If
+        `overwrite` is True, fields not in the dict are removed
+        """
+        if overwrite:
+            for field in self.fields(i):
+                if field not in ret:
+                    self.set_value(i, field, absent)
+        for field, value in ret.iteritems():
+            self.set_value(i, field, value)
+
+    def get_updates(self, exclude_new=()):
+        """
+        Return the list of update documents ($set and $unset operators) with
+        the changes of every row, None for unchanged rows. Fields from
+        `exclude_new` which were absent in the source record are not written
+        """
+        set_fields = defaultdict(dict)
+        unset_fields = defaultdict(dict)
+        for field in self.written:
+            column = self.columns[field]
+            if type(column) is Column:
+                column = column.get_values(xrange(self.size), absent)
+            original = self.original.get(field) or [absent] * self.size
+            for i, (orig_value, value) in enumerate(zip(original, column)):
+                if value is orig_value:
+                    continue
+                if value is absent:
+                    unset_fields[i][field] = ''
+                elif orig_value is absent:
+                    if field not in exclude_new:
+                        set_fields[i][field] = value
+                elif orig_value != value and not (orig_value != orig_value and value != value):
+                    # NaN values are equal
+                    set_fields[i][field] = value
+
+        updates = [None] * self.size
+        for i, set_row in set_fields.iteritems():
+            updates[i] = {'$set': set_row}
+        for i, unset_row in unset_fields.iteritems():
+            updates[i] = updates[i] or {}
+            updates[i]['$unset'] = unset_row
+        return updates
+
+
+class EditRow(object):
+    """
+    Mapping view of the row of `EditBatch`, usable as the record and as
+    keyword arguments of the extension functions
+    """
+    __slots__ = ['batch', 'i']
+
+    def __init__(self, batch, i):
+        self.batch = batch
+        self.i = i
+
+    def keys(self):
+        return self.batch.fields(self.i)
+
+    def __getitem__(self, field):
+        value = self.batch.get(self.i, field, absent)
+        if value is absent:
+            raise KeyError(field)
+        return value
+
+    def __setitem__(self, field, value):
+        self.batch.set_value(self.i, field, value)
+
+    def __contains__(self, field):
+        return self.batch.get(self.i, field, absent) is not absent
+
+    def get(self, field, default=None):
+        return self.batch.get(self.i, field, default)
+
+
+def apply_to_record(record, functions, incremental=False):
+    """
+    Apply the sequence of functions to the record.
+
+    Return the update document with the changed fields, or None if the record
+    hasn't been changed
+    """
+    updates = apply_to_records([record], functions, incremental)
+    return updates[0][1] if updates else None
+
+
+def apply_to_records(records, functions, incremental=False, stats=None):
+    """
+    Apply the sequence of functions to the list of records. Functions with
+    batch implementations (see `batched`) are called once for all records,
+    functions with columnar implementations (see `columnar`) write their
+    outputs directly to the columns of the `EditBatch`.
+
+    Fingerprints of the stages are stored in the "fingerprints" field of the
+    record. If `incremental` is True, stages with unchanged fingerprints are
+    skipped.
+
+    If `stats` (PipelineStats) is given, function calls are timed.
+
+    Return the list of (_id, update document) tuples for changed records
+    """
+    batch = EditBatch(records)
+    fingerprints = [dict(batch.get(i, 'fingerprints') or {}) for i in xrange(batch.size)]
+    record_seconds = [0.0] * batch.size
+
+    for func in functions:
+        is_stage = hasattr(func, 'version')
+        idx = range(batch.size)
+        if is_stage:
+            idx = []
+            for i, fingerprint in enumerate(get_fingerprints(func, batch, range(batch.size))):
+                if incremental and fingerprints[i].get(func.key) == fingerprint:
+                    continue
+                fingerprints[i][func.key] = fingerprint
+                idx.append(i)
+        if not idx:
+            continue
+
+        if set(revision_fields) & set(getattr(func, 'fields', ())):
+            start = time.time()
+            loaded = load_record_revisions([batch.row(i) for i in idx])
+            if stats is not None and loaded:
+                stats.add_stage('load_revisions', [time.time() - start], len(loaded),
+                                sum(len(row[field]) for row, field in loaded))
+
+        if stats is not None:
+            rets, seconds = stats.call(func, batch, idx)
+            for i, record_time in zip(idx, seconds):
+                record_seconds[i] += record_time
+        else:
+            rets = call_stage(func, batch, idx)
+
+        for field in getattr(func, 'removes', ()):
+            batch.set_values(field, idx, [absent] * len(idx))
+        changed_inputs = []
+        for n, i in enumerate(idx):
+            if rets is None:
+                # columnar implementations write their declared outputs
+                changes_inputs = is_stage and bool(set(getattr(func, 'outputs', ())) & set(func.fields))
+            else:
+                ret = rets[n]
+                overwrite = False
+                if isinstance(ret, tuple):
+                    ret, overwrite = ret
+                if not ret:
+                    continue
+                batch.update(i, ret, overwrite)
+                changes_inputs = is_stage and (overwrite or set(ret) & set(func.fields))
+            if changes_inputs:
+                changed_inputs.append(i)
+        if changed_inputs:
+            # the stage changed its own inputs, and the next run has to see
+            # them as unchanged
+            for i, fingerprint in zip(changed_inputs, get_fingerprints(func, batch, changed_inputs)):
+                fingerprints[i][func.key] = fingerprint
+
+    for i, record_fingerprints in enumerate(fingerprints):
+        if record_fingerprints:
+            batch.set_value(i, 'fingerprints', record_fingerprints)
+    # revisions loaded lazily are not written back
+    updates = [(_id, update) for _id, update in zip(batch.ids, batch.get_updates(revision_fields))
+               if update is not None]
+
+    if stats is not None:
+        for i, seconds in enumerate(record_seconds):
+            stats.add_record(batch.row(i), seconds)
+    return updates
+
+
+def call_stage(func, batch, idx):
+    """
+    Call the extension function for the rows `idx` of the batch. Return the
+    list of results, or None if the columnar implementation of the function
+    has written them to the batch
+    """
+    columnar_func = getattr(func, 'columnar', None)
+    if columnar_func is not None:
+        columnar_func(batch, idx)
+        return None
+    rows = [batch.row(i) for i in idx]
+    batch_func = getattr(func, 'batch', None)
+    if batch_func is not None:
+        return batch_func(rows)
+    return [func(**row) for row in rows]
+
+
+def extend_records(records, functions):
+    """
+    Apply the sequence of functions to the list of records in memory: unlike
+    `apply_to_records`, no fingerprints are computed and nothing is loaded
+    from the storage, so the records must contain all the inputs (including
+    revision contents).
+
+    Return the list of extended records
+    """
+    records = list(records)
+    if not records:
+        return records
+    for func in functions:
+        batch_func = getattr(func, 'batch', None)
+        if batch_func is not None:
+            rets = batch_func(records)
+        else:
+            rets = [func(**record) for record in records]
+        for i, ret in enumerate(rets):
+            overwrite = False
             if isinstance(ret, tuple):
                 ret, overwrite = ret
-
             if ret:
-                if overwrite:
-                    record = ret
-                else:
-                    record = dict(record, **ret)
+                records[i] = ret if overwrite else dict(records[i], **ret)
+        removes = getattr(func, 'removes', ())
+        if removes:
+            records = [{k: v for k, v in record.iteritems() if k not in removes}
+                       for record in records]
+    return records
+
+
+def apply_to_range(task):
+    """
+    Worker function of the parallel `apply`. Process all records matching the
+    spec with `_id` in the [lo, hi] range and return the tuple (list of (_id, update
+    document) tuples, number of processed records, PipelineStats or None)
+    """
+    functions, incremental, spec, lo, hi, instrument, profile = task
+    stats = PipelineStats() if instrument else None
+    sampler = Sampler().start() if profile else None
+    try:
+        start = time.time()
+        spec = dict(spec or {}, _id={'$gte': lo, '$lte': hi})
+        records = list(corpus.find(spec, fields=get_projection(functions, instrument)))
+        if stats is not None:
+            stats.add_stage('read', [time.time() - start], len(records))
+            counters = get_memo_counters()
+        updates = apply_to_records(records, functions, incremental, stats)
+        if stats is not None:
+            stats.add_cache_counters(counters)
+    finally:
+        if sampler is not None:
+            stats.samples.update(sampler.stop())
+    return updates, len(records), stats
+
+
+def iter_chunks(iterable, chunk_size):
+    """
+    Split the iterable to lists of up to `chunk_size` items
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def get_id_ranges(chunk_size, spec=None):
+    """
+    Split the corpus (or the records matching the spec) to the list of
+    (lo, hi) tuples, each of them covering up to `chunk_size` records with
+    `lo <= _id <= hi`
+    """
+    ranges = []
+    ids = []
+    cursor = corpus.find(spec or {}, fields=['_id']).sort('_id', 1)
+    for record in cursor:
+        ids.append(record['_id'])
+        if len(ids) >= chunk_size:
+            ranges.append((ids[0], ids[-1]))
+            ids = []
+    if ids:
+        ranges.append((ids[0], ids[-1]))
+    return ranges
+
+
+#--- Instrumentation
+
+# upper bounds of the buckets of timing histograms, in seconds
+histogram_bounds = [1e-5, 1e-4, 1e-3, 1e-2, 1e-1, 1, 10]
+
+
+def get_histogram_bucket(seconds):
+    for i, bound in enumerate(histogram_bounds):
+        if seconds < bound:
+            return i
+    return len(histogram_bounds)
+
+
+def format_seconds(seconds):
+    if seconds < 1e-3:
+        return '%dus' % round(seconds * 1e6)
+    if seconds < 1:
+        return '%dms' % round(seconds * 1e3)
+    return '%gs' % seconds
+
+
+class PipelineStats(object):
+    """
+    Statistics of the `apply` run:
+
+    - stages: {function name: {'calls', 'records', 'seconds', 'bytes',
+      'histogram'}}. Calls of batch implementations are counted once per
+      batch, and "records" is the number of records passed. Histograms count
+      calls by duration (see `histogram_bounds`). Pseudo-stages "read" and
+      "load_revisions" measure fetching records and their revisions
+    - writes: {'calls', 'operations', 'seconds', 'histogram'} of bulk writes
+    - slowest: list of (seconds, editid, _id) of the slowest records (the time
+      of a batch call is split evenly between its records)
+    - samples: Counter of stacks collected by the sampling profiler
+    - caches: {cache name: Counter of hits and misses} of memoization caches
+      (see `MemoCache`)
+
+    Stats collected by worker processes are merged with `add_chunk`
+    """
+
+    def __init__(self, callbacks=None, slowest=20):
+        self.callbacks = list(callbacks or [])
+        self.max_slowest = slowest
+        self.stages = OrderedDict()
+        self.writes = {'calls': 0, 'operations': 0, 'seconds': 0.0,
+                       'histogram': [0] * (len(histogram_bounds) + 1)}
+        self.records = 0
+        self.slowest = []
+        self.samples = Counter()
+        self.caches = {}
+
+    def __getstate__(self):
+        # callbacks are not sent between processes
+        return dict(self.__dict__, callbacks=[])
+
+    def emit(self, event, stats):
+        for callback in self.callbacks:
+            callback(event, stats)
+
+    def call(self, func, batch, idx):
+        """
+        Call the function for the rows `idx` of the batch (see `call_stage`).
+        Return the tuple (results, list of seconds per record)
+        """
+        fields = getattr(func, 'fields', None) or ()
+        size = 0
+        for i in idx:
+            for field in fields:
+                value = batch.get(i, field)
+                if isinstance(value, basestring):
+                    size += len(value)
+        if getattr(func, 'batch', None) is not None or getattr(func, 'columnar', None) is not None:
+            start = time.time()
+            rets = call_stage(func, batch, idx)
+            elapsed = time.time() - start
+            seconds = [elapsed / len(idx)] * len(idx)
+            self.add_stage(func.__name__, [elapsed], len(idx), size)
+        else:
+            rets = []
+            seconds = []
+            for i in idx:
+                row = batch.row(i)
+                start = time.time()
+                rets.append(func(**row))
+                seconds.append(time.time() - start)
+            self.add_stage(func.__name__, seconds, len(idx), size)
+        return rets, seconds
+
+    def add_stage(self, name, call_seconds, records, size=0):
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = {'calls': 0, 'records': 0, 'seconds': 0.0, 'bytes': 0,
+                                         'histogram': [0] * (len(histogram_bounds) + 1)}
+        stage['calls'] += len(call_seconds)
+        stage['records'] += records
+        stage['seconds'] += sum(call_seconds)
+        stage['bytes'] += size
+        for seconds in call_seconds:
+            stage['histogram'][get_histogram_bucket(seconds)] += 1
+
+    def add_write(self, operations, seconds):
+        self.writes['calls'] += 1
+        self.writes['operations'] += operations
+        self.writes['seconds'] += seconds
+        self.writes['histogram'][get_histogram_bucket(seconds)] += 1
+        self.emit('write', self)
+
+    def add_record(self, record, seconds):
+        self.records += 1
+        item = (seconds, record.get('editid'), record.get('_id'))
+        if len(self.slowest) < self.max_slowest:
+            heapq.heappush(self.slowest, item)
+        else:
+            heapq.heappushpop(self.slowest, item)
+
+    def add_cache_counters(self, before):
+        """
+        Add the hits and misses of memoization caches since `before` (result
+        of `get_memo_counters`)
+        """
+        for name, counter in get_memo_counters().iteritems():
+            counter.subtract(before.get(name, {}))
+            self.caches.setdefault(name, Counter()).update(counter)
+
+    def add_chunk(self, chunk_stats):
+        """
+        Merge the stats of the processed chunk
+        """
+        for name, chunk_stage in chunk_stats.stages.iteritems():
+            stage = self.stages.get(name)
+            if stage is None:
+                self.stages[name] = dict(chunk_stage, histogram=list(chunk_stage['histogram']))
+                continue
+            for key in ['calls', 'records', 'seconds', 'bytes']:
+                stage[key] += chunk_stage[key]
+            stage['histogram'] = [a + b for a, b in zip(stage['histogram'], chunk_stage['histogram'])]
+        self.records += chunk_stats.records
+        for item in chunk_stats.slowest:
+            if len(self.slowest) < self.max_slowest:
+                heapq.heappush(self.slowest, item)
+            else:
+                heapq.heappushpop(self.slowest, item)
+        self.samples.update(chunk_stats.samples)
+        for name, counter in chunk_stats.caches.iteritems():
+            self.caches.setdefault(name, Counter()).update(counter)
+        self.emit('chunk', chunk_stats)
+
+    def get_slowest(self):
+        return sorted(self.slowest, reverse=True)
+
+    def save_profile(self, filename):
+        """
+        Save the samples of the profiler in the "collapsed stacks" format of
+        flamegraph.pl and speedscope
+        """
+        with open(filename, 'w') as f:
+            for stack, count in self.samples.most_common():
+                f.write('%s %d\n' % (stack, count))
+
+    def report(self, top=10):
+        """
+        Return the summary report as a string
+        """
+        header = ['stage', 'calls', 'records', 'seconds', 'MB', 'records/s']
+        header += ['<' + format_seconds(bound) for bound in histogram_bounds] + ['more']
+        rows = [header]
+        for name, stage in self.stages.iteritems():
+            rows.append([name, stage['calls'], stage['records'], '%.3f' % stage['seconds'],
+                         '%.1f' % (stage['bytes'] / (1 << 20)),
+                         '%.1f' % (stage['records'] / stage['seconds'] if stage['seconds'] else 0)]
+                        + stage['histogram'])
+        rows.append(['write', self.writes['calls'], self.writes['operations'],
+                     '%.3f' % self.writes['seconds'], '',
+                     '%.1f' % (self.writes['operations'] / self.writes['seconds']
+                               if self.writes['seconds'] else 0)]
+                    + self.writes['histogram'])
+        widths = [max(len(str(row[i])) for row in rows) for i in xrange(len(header))]
+        lines = ['  '.join(str(v).rjust(w) if i else str(v).ljust(w)
+                           for i, (v, w) in enumerate(zip(row, widths)))
+                 for row in rows]
+
+        if self.caches:
+            lines.append('')
+        for name, counter in sorted(self.caches.iteritems()):
+            total = (counter['memory_hits'] + counter['db_hits'] + counter['deduplicated'] +
+                     counter['misses'])
+            if total:
+                lines.append('Cache %s: hit rate %.1f%% (memory hits %d, storage hits %d, '
+                             'deduplicated %d, misses %d)'
+                             % (name, 100 * (total - counter['misses']) / total,
+                                counter['memory_hits'], counter['db_hits'],
+                                counter['deduplicated'], counter['misses']))
+
+        lines.append('')
+        lines.append('Slowest records:')
+        for seconds, editid, _id in self.get_slowest()[:top]:
+            lines.append('  editid=%s _id=%s %s' % (editid, _id, format_seconds(seconds)))
+
+        if self.samples:
+            own = Counter()
+            for stack, count in self.samples.iteritems():
+                own[stack.rsplit(';', 1)[-1]] += count
+            total = sum(own.itervalues())
+            lines.append('')
+            lines.append('Top functions by own samples (of %d):' % total)
+            for frame, count in own.most_common(top):
+                lines.append('  %5.1f%%  %s' % (100 * count / total, frame))
+        return '\n'.join(lines)
+
+
+class Sampler(object):
+    """
+    Sampling profiler: collects the stack of the main thread every `interval`
+    seconds of the CPU time (SIGPROF), so it has to be started in the main
+    thread
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = Counter()
+
+    def start(self):
+        signal.signal(signal.SIGPROF, self.sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        return self
+
+    def stop(self):
+        """
+        Stop sampling and return the Counter {stack: number of samples}
+        """
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+        return self.samples
+
+    def sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename),
+                                         code.co_firstlineno))
+            frame = frame.f_back
+        self.samples[';'.join(reversed(stack))] += 1
+
+
+def get_memory_usage():
+    """
+    Return (resident set size, peak resident set size) of the current process,
+    in MB. On Linux, the peak can be reset with `reset_peak_memory`,
+    elsewhere it's the peak since the process start
+    """
+    try:
+        with open('/proc/self/status') as f:
+            status = dict(line.split(':', 1) for line in f)
+        return int(status['VmRSS'].split()[0]) / 1024, int(status['VmHWM'].split()[0]) / 1024
+    except (IOError, KeyError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        return peak, peak
+
+
+def reset_peak_memory():
+    gc.collect()
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except IOError:
+        pass
 
-        if record != orig_record:
-            corpus.update({'_id': record['_id']}, record)
 
+def print_results(results):
+    for name, result in results.iteritems():
+        print '%-20s %s' % (name, ' '.join('%s=%.4g' % item for item in sorted(result.iteritems())))
 
+
+def save_results(filename, benchmark, results):
+    with open(filename, 'w') as f:
+        json.dump({'benchmark': benchmark,
+                   'time': time.time(),
+                   'python': sys.version,
+                   'results': results}, f, indent=2)
+
+
+#--- Memoization
+
+class LRUCache(object):
+    """
+    Bounded thread-safe in-memory cache, evicting least recently used items
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.items[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def pop(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+class MemoCache(object):
+    """
+    Bounded cache of results of a function of strings (token sets, metrics),
+    keyed by the hash of the string content, so that texts repeated across
+    edits (revisions shared by consecutive edits, bot comments) are processed
+    once.
+
+    Up to `maxsize` least recently used results are kept in memory. If
+    `persist` is True, results are also stored in the memocache collection as
+    zlib-compressed JSON and survive across runs.
+
+    :param name: name of the cache
+    :param version: version of the function, part of the key
+    :param encode: function converting the result to JSON-serializable value
+    :param decode: inverse of `encode`
+    """
+
+    def __init__(self, name, version=1, maxsize=1000, persist=None, encode=None, decode=None,
+                 collection=None):
+        self.name = name
+        self.prefix = '%s:%s:' % (name, version)
+        self.memory = LRUCache(maxsize)
+        self.persist = MEMOCACHE_PERSIST if persist is None else persist
+        self.encode = encode or (lambda value: value)
+        self.decode = decode or (lambda value: value)
+        self.collection = collection
+        self.stats = Counter()
+        memo_caches.append(self)
+
+    def get_key(self, text):
+        return self.prefix + hashlib.sha1(text.encode('utf8')).hexdigest()
+
+    def get_many(self, texts, func):
+        """
+        Return the list of results for the texts. Results missing in the cache
+        are computed for all of them at once with func(list of texts), which
+        has to return the list of results
+        """
+        keys = [self.get_key(text) for text in texts]
+        results = {}
+        for key in keys:
+            if key not in results:
+                value = self.memory.get(key, absent)
+                if value is not absent:
+                    results[key] = value
+        self.stats['memory_hits'] += len(results)
+        # texts repeated in the batch are looked up and computed once
+        self.stats['deduplicated'] += len(keys) - len(set(keys))
+
+        missing = [key for key in set(keys) if key not in results]
+        if missing and self.persist:
+            for doc in self.get_collection().find({'key': {'$in': missing}}):
+                value = self.decode(json.loads(zlib.decompress(doc['zval'])))
+                results[doc['key']] = value
+                self.memory.set(doc['key'], value)
+                self.stats['db_hits'] += 1
+
+        missing_texts = OrderedDict()
+        for key, text in zip(keys, texts):
+            if key not in results:
+                missing_texts[key] = text
+        self.stats['misses'] += len(missing_texts)
+        if missing_texts:
+            values = func(missing_texts.values())
+            writer = BulkWriter(self.get_collection()) if self.persist else None
+            for key, value in zip(missing_texts, values):
+                results[key] = value
+                self.memory.set(key, value)
+                if writer is not None:
+                    data = binary_type()(zlib.compress(json.dumps(self.encode(value))))
+                    writer.upsert({'key': key}, {'key': key, 'zval': data})
+            if writer is not None:
+                writer.flush()
+        return [results[key] for key in keys]
+
+    def get(self, text, func):
+        """
+        Return func(text), cached
+        """
+        return self.get_many([text], lambda texts: [func(t) for t in texts])[0]
+
+    def get_collection(self):
+        return memocache if self.collection is None else self.collection
+
+    def clear(self):
+        """
+        Drop the results kept in memory (persisted ones are kept)
+        """
+        self.memory.clear()
+
+    def get_stats(self):
+        """
+        Return the dict of hit / miss counters and the hit rate. Texts
+        repeated in a batch ("deduplicated") count as hits
+        """
+        stats = dict(self.stats, memory_size=len(self.memory))
+        total = sum(self.stats[k] for k in ['memory_hits', 'db_hits', 'deduplicated', 'misses'])
+        stats['hit_rate'] = None if total == 0 else (total - self.stats['misses']) / total
+        return stats
+
+
+memo_caches = []
+
+
+def get_memo_counters():
+    """
+    Return the dict {cache name: Counter of hits and misses} of all caches
+    """
+    return {cache.name: Counter(cache.stats) for cache in memo_caches}
+
+
+def clear_memo_caches():
+    """
+    Drop the results kept in memory by all caches, e.g. to measure the
+    functions again on the same texts
+    """
+    for cache in memo_caches:
+        cache.clear()
+
+
+tokens_cache = MemoCache('tokens', version=1, maxsize=TOKENS_CACHE_SIZE,
+                         encode=lambda value: [sorted(value[0]), sorted(value[1])],
+                         decode=lambda value: (frozenset(value[0]), frozenset(value[1])))
+
+
+def tokenize_sets_many(texts):
+    """
+    Return the list of (set of chunks, set of urls) tuples for the texts, see
+    `tokenize_keep_urls`. Cached in `tokens_cache`
+    """
+    def tokenize_sets(texts):
+        ret = []
+        for text in texts:
+            chunks, urls = tokenize_keep_urls(text)
+            ret.append((frozenset(chunks), frozenset(urls)))
+        return ret
+    return tokens_cache.get_many(texts, tokenize_sets)
+
+
+# fields of previous versions of the pipeline (current stage outputs are kept
+# and recomputed when stage fingerprints change)
+cleanup_fields = ['ul_ratio', 'u_ratio', 'd_ratio', 'non_alnum_ratio', 'compressibility',
+        'longest_word', 'longest_seq', 'diff_word', 'neg_ul_ratio',
+        'neg_u_ratio', 'neg_d_ratio', 'neg_non_alnum_ratio',
+        'neg_compressibility', 'neg_longest_word', 'neg_longest_seq',
+        'neg_diff_word']
+
+
+@stage(inputs=['editcomment'] + cleanup_fields, outputs=['editcomment'])
 def cleanup(**record):
-    for key in ['difflen', 'commentlen', 'empty_comment', 'sz_ratio', 'ul_ratio',
-            'u_ratio', 'd_ratio', 'non_alnum_ratio', 'compressibility',
-            'longest_word', 'longest_seq', 'diff_word', 'neg_ul_ratio',
-            'neg_u_ratio', 'neg_d_ratio', 'neg_non_alnum_ratio',
-            'neg_compressibility', 'neg_longest_word', 'neg_longest_seq',
-            'neg_diff_word']:
+    for key in cleanup_fields:
         record.pop(key, None)
     if record['editcomment'] == 'null':
         record['editcomment'] = ''
     return record, True
 
 
+@columnar(cleanup)
+def cleanup_columns(batch, idx):
+    for key in cleanup_fields:
+        batch.set_values(key, idx, [absent] * len(idx))
+    comments = batch.get_values('editcomment', idx)
+    null_idx = [i for i, comment in zip(idx, comments) if comment == 'null']
+    batch.set_values('editcomment', null_idx, [''] * len(null_idx))
+
+
+# outputs of extend_with_region_diff only
+region_diff_fields = ['diff_pos', 'diff_regions', 'diff_lines_added', 'diff_lines_removed']
+
+
+@stage(inputs=['oldrevision', 'newrevision'],
+       outputs=['diff', 'neg_diff', 'urls', 'neg_urls', 'urls_added', 'urls_removed'],
+       version=(2, 'full'), key='extend_with_diff', removes=region_diff_fields)
 def extend_with_diff(oldrevision, newrevision, **record):
+    return extend_with_diff_batch([dict(record, oldrevision=oldrevision, newrevision=newrevision)])[0]
 
-    # preprocess the text to replace url with word-alike sequences
-    old_rev, old_pr_map = keep_urls_preprocess(oldrevision)
-    new_rev, new_pr_map = keep_urls_preprocess(newrevision)
 
-    # split the text to chunks and replace back word-alike sequences with urls
-    old_rev_chunks = keep_urls_postprocess(nltk.word_tokenize(old_rev), old_pr_map)
-    new_rev_chunks = keep_urls_postprocess(nltk.word_tokenize(new_rev), new_pr_map)
+@batched(extend_with_diff)
+def extend_with_diff_batch(records):
+    """
+    Revisions of all records are tokenized at once through `tokens_cache`, so
+    the revision which is new for one edit and old for the next one is
+    tokenized once
+    """
+    tokens = tokenize_sets_many([record[field] for record in records
+                                 for field in ['oldrevision', 'newrevision']])
+    ret = []
+    for i in xrange(len(records)):
+        # split the text to chunks, keeping urls intact
+        old_rev_set, old_rev_urls = tokens[2 * i]
+        new_rev_set, new_rev_urls = tokens[2 * i + 1]
+
+        # find the "positive diff": all the records which have been added by the edit
+        diff_set = sorted(new_rev_set.difference(old_rev_set))
+        diff_word = u' '.join(diff_set)
+
+        # find the "negative diff": all the record which have been removed by the edit
+        neg_diff_set = sorted(old_rev_set.difference(new_rev_set))
+        neg_diff_word = u' '.join(neg_diff_set)
+
+        # find the positive diff for URLs
+        url_diff_set = sorted(new_rev_urls.difference(old_rev_urls))
+        url_diff_word = u' '.join(url_diff_set)
+        urls_added = bool(url_diff_set)
+
+        # find the negative diff for URLs
+        neg_url_diff_set = sorted(old_rev_urls.difference(new_rev_urls))
+        neg_url_diff_word = u' '.join(neg_url_diff_set)
+        urls_removed = bool(neg_url_diff_set)
+
+        ret.append({'diff': diff_word,
+                    'neg_diff': neg_diff_word,
+                    'urls': url_diff_word,
+                    'neg_urls': neg_url_diff_word,
+                    'urls_added': urls_added,
+                    'urls_removed': urls_removed})
+    return ret
+
 
-    # make sure all the chunks are unique
+@stage(inputs=['oldrevision', 'newrevision'],
+       outputs=['diff', 'neg_diff', 'urls', 'neg_urls', 'urls_added', 'urls_removed'] + region_diff_fields,
+       version=(2, 'regions'), key='extend_with_diff')
+def extend_with_region_diff(oldrevision, newrevision, **record):
+    """
+    The same as extend_with_diff, but only the changed regions of revisions
+    are tokenized, so that the cost depends on the size of the edit rather
+    than the size of the article.
+
+    Unlike extend_with_diff, a chunk added in the changed region is considered
+    new even if it occurs elsewhere in the old revision.
+
+    Both implementations keep the fingerprint under the same stage key, so
+    switching ANTIVANDAL_DIFF_MODE recomputes the stage, and the full diff
+    removes the positional features.
+
+    Additionally returns positional features:
+
+    - diff_pos: relative position of the first changed character in the old
+      revision, (position + 1) / (length + 1)
+    - diff_regions: number of changed blocks of lines
+    - diff_lines_added, diff_lines_removed: number of changed lines
+    """
+    old_regions, new_regions, opcodes, first_change = get_changed_regions(oldrevision, newrevision)
+
+    old_rev_chunks, old_rev_urls = tokenize_keep_urls(u'\n'.join(old_regions))
+    new_rev_chunks, new_rev_urls = tokenize_keep_urls(u'\n'.join(new_regions))
     old_rev_set = set(old_rev_chunks)
     new_rev_set = set(new_rev_chunks)
 
-    # find the "positive diff": all the records which have been added by the edit
     diff_set = sorted(new_rev_set.difference(old_rev_set))
-    diff_word = u' '.join(diff_set)
-
-    # find the "negative diff": all the record which have been removed by the edit
     neg_diff_set = sorted(old_rev_set.difference(new_rev_set))
-    neg_diff_word = u' '.join(neg_diff_set)
+    url_diff_set = sorted(new_rev_urls.difference(old_rev_urls))
+    neg_url_diff_set = sorted(old_rev_urls.difference(new_rev_urls))
 
-    # keep track of old and new urls
-    old_rev_urls = set(old_pr_map.values())
-    new_rev_urls = set(new_pr_map.values())
+    changed = [op for op in opcodes if op[0] != 'equal']
+    return {'diff': u' '.join(diff_set),
+            'neg_diff': u' '.join(neg_diff_set),
+            'urls': u' '.join(url_diff_set),
+            'neg_urls': u' '.join(neg_url_diff_set),
+            'urls_added': bool(url_diff_set),
+            'urls_removed': bool(neg_url_diff_set),
+            'diff_pos': (first_change + 1) / (len(oldrevision) + 1),
+            'diff_regions': len(changed),
+            'diff_lines_added': sum(j2 - j1 for _, _, _, j1, j2 in changed),
+            'diff_lines_removed': sum(i2 - i1 for _, i1, i2, _, _ in changed)}
 
-    # find the positive diff for URLs
-    url_diff_set = sorted(new_rev_urls.difference(old_rev_urls))
-    url_diff_word = u' '.join(url_diff_set)
-    urls_added = bool(url_diff_set)
 
-    # find the negative diff for URLs
-    neg_url_diff_set = sorted(old_rev_urls.difference(new_rev_urls))
-    neg_url_diff_word = u' '.join(neg_url_diff_set)
-    urls_removed = bool(neg_url_diff_set)
+def get_changed_regions(old, new):
+    """
+    Find regions of the text changed by the edit.
 
-    ret =  {'diff': diff_word,
-            'neg_diff': neg_diff_word,
-            'urls': url_diff_word,
-            'neg_urls': neg_url_diff_word,
-            'urls_added': urls_added,
-            'urls_removed': urls_removed}
+    Common prefix and suffix of revisions (expanded to the line boundaries)
+    are trimmed, and the rest is compared line by line with difflib.
 
-    return ret
+    Return the tuple (list of changed regions of the old revision, list of
+    changed regions of the new revision, difflib opcodes of the trimmed
+    lines, position of the first changed character, i.e. the length of the
+    common prefix before expanding it to the line boundary)
+    """
+    first_change = common_prefix_len(old, new)
+    prefix_len = old.rfind('\n', 0, first_change) + 1
+    max_suffix_len = min(len(old), len(new)) - prefix_len
+    suffix_len = common_suffix_len(old, new, max_suffix_len)
+    if suffix_len:
+        # move the suffix start to the next line
+        line_end = old.find('\n', len(old) - suffix_len)
+        suffix_len = 0 if line_end == -1 else len(old) - line_end
+
+    old_lines = old[prefix_len:len(old) - suffix_len].splitlines()
+    new_lines = new[prefix_len:len(new) - suffix_len].splitlines()
+
+    old_regions = []
+    new_regions = []
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+    opcodes = matcher.get_opcodes()
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag != 'equal':
+            old_regions.append(u'\n'.join(old_lines[i1:i2]))
+            new_regions.append(u'\n'.join(new_lines[j1:j2]))
+    return old_regions, new_regions, opcodes, first_change
+
+
+def common_prefix_len(a, b):
+    """
+    Length of the common prefix of two strings (binary search over slices)
+    """
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[lo:mid] == b[lo:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def common_suffix_len(a, b, max_len):
+    """
+    Length of the common suffix of two strings, not longer than max_len
+    """
+    lo, hi = 0, max_len
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[len(a) - mid:len(a) - lo] == b[len(b) - mid:len(b) - lo]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
 
 
+@stage(inputs=['oldrevision', 'newrevision', 'editcomment'],
+       outputs=['difflen', 'commentlen', 'empty_comment', 'blanking', 'sz_ratio'])
 def extend_with_basic_text_metrics(oldrevision, newrevision, editcomment, **kw):
     return {
         'difflen': len(newrevision) - len(oldrevision),
@@ -284,39 +2089,179 @@ def extend_with_basic_text_metrics(oldrevision, newrevision, editcomment, **kw):
     }
 
 
+@columnar(extend_with_basic_text_metrics)
+def extend_with_basic_text_metrics_columns(batch, idx):
+    old_lens = [len(text) for text in batch.get_values('oldrevision', idx)]
+    new_lens = [len(text) for text in batch.get_values('newrevision', idx)]
+    comment_lens = [len(comment) for comment in batch.get_values('editcomment', idx)]
+    batch.set_values('difflen', idx, [new - old for old, new in zip(old_lens, new_lens)])
+    batch.set_values('commentlen', idx, comment_lens)
+    batch.set_values('empty_comment', idx, [n == 0 for n in comment_lens])
+    batch.set_values('blanking', idx, [n == 0 for n in new_lens])
+    batch.set_values('sz_ratio', idx, [(new + 1) / (old + 1) for old, new in zip(old_lens, new_lens)])
+
+
+ratio_metrics_keys = ['diff', 'neg_diff', 'editcomment']
+
+
+@stage(inputs=ratio_metrics_keys,
+       outputs=['%s_%s' % (key, metric)
+                for key in ratio_metrics_keys
+                for metric in ['ul_ratio', 'u_ratio', 'd_ratio',
+                               'non_alnum_ratio', 'compressibility']],
+       version=(3, COMPRESSOR))
 def extend_with_ratio_metrics(**record):
-    ret = {}
+    return extend_with_ratio_metrics_batch([record])[0]
 
-    for key in ['diff', 'neg_diff', 'editcomment']:
-        value = record[key]
 
-        total_len = len(value)
-        upper_len = sum(c in uppercase for c in value)
-        lower_len = sum(c in uppercase for c in value)
-        digits_len = sum(c in digits for c in value)
-        alnum_len = sum(c in alphanum for c in value)
+@batched(extend_with_ratio_metrics)
+def extend_with_ratio_metrics_batch(records):
+    ret = [{} for _ in records]
+    for key in ratio_metrics_keys:
+        metrics = cached_ratio_metrics_columns([record[key] for record in records])
+        for metric, values in metrics.iteritems():
+            for record_ret, value in zip(ret, values):
+                record_ret[key + '_' + metric] = value
+    return ret
+
+
+@columnar(extend_with_ratio_metrics)
+def extend_with_ratio_metrics_columns(batch, idx):
+    for key in ratio_metrics_keys:
+        metrics = cached_ratio_metrics_columns(batch.get_values(key, idx))
+        for metric, values in metrics.iteritems():
+            batch.set_values(key + '_' + metric, idx, values)
 
-        if value == 0:
-            compressed_len = 0
-        else:
-            compressed_len = len(list(lzw.compress(value.encode('utf8'))))
 
-        ret.update({
-            key + '_ul_ratio': None if lower_len == 0 else upper_len / lower_len,
-            key + '_u_ratio': None if total_len == 0 else upper_len / total_len,
-            key + '_d_ratio': None if total_len == 0 else digits_len / total_len,
-            key + '_non_alnum_ratio': None if total_len == 0 else (total_len - alnum_len) / total_len,
-            key + '_compressibility': None if compressed_len == 0 else total_len / compressed_len,
-        })
+ratio_metrics_names = ['ul_ratio', 'u_ratio', 'd_ratio', 'non_alnum_ratio', 'compressibility']
 
+ratio_metrics_cache = MemoCache('ratio_metrics', version=extend_with_ratio_metrics.version,
+                                maxsize=METRICS_CACHE_SIZE, decode=tuple)
+
+
+def cached_ratio_metrics_columns(values):
+    """
+    The same as `ratio_metrics_columns`, cached in `ratio_metrics_cache`
+    """
+    def compute(values):
+        metrics = ratio_metrics_columns(values)
+        return zip(*[metrics[name] for name in ratio_metrics_names])
+    rows = ratio_metrics_cache.get_many(values, compute)
+    return OrderedDict(zip(ratio_metrics_names, zip(*rows) if rows else [[]] * len(ratio_metrics_names)))
+
+
+def ratio_metrics_batch(values, compressor=None):
+    """
+    Compute ratio metrics for the list of strings at once, return the list of
+    dicts with keys ul_ratio, u_ratio, d_ratio, non_alnum_ratio and
+    compressibility
+    """
+    metrics = ratio_metrics_columns(values, compressor)
+    return [dict(zip(metrics, record_values)) for record_values in zip(*metrics.values())]
+
+
+def ratio_metrics_columns(values, compressor=None):
+    """
+    Compute ratio metrics for the list of strings at once. Character classes
+    are counted with numpy lookup tables over the utf8-encoded buffer of all
+    strings (all classes are ASCII, so byte counts equal character counts).
+
+    :param compressor: "zlib" (the default) or "lzw" (pure Python and much
+                       slower, but compatible with the results of previous
+                       versions)
+
+    Return the dict {metric: list of values} with metrics ul_ratio, u_ratio,
+    d_ratio, non_alnum_ratio and compressibility
+    """
+    compressor = compressor or COMPRESSOR
+    encoded = [value.encode('utf8') for value in values]
+    buf = np.frombuffer(''.join(encoded), dtype=np.uint8)
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(data) for data in encoded])
+
+    def count(table):
+        cumsum = np.zeros(len(buf) + 1, dtype=np.int64)
+        np.cumsum(table[buf], out=cumsum[1:])
+        return (cumsum[offsets[1:]] - cumsum[offsets[:-1]]).tolist()
+
+    uppercase_table, lowercase_table, digits_table, alphanum_table = get_char_tables()
+    upper_lens = count(uppercase_table)
+    lower_lens = count(lowercase_table)
+    digits_lens = count(digits_table)
+    alnum_lens = count(alphanum_table)
+
+    ret = OrderedDict((metric, []) for metric in ratio_metrics_names)
+    for i, value in enumerate(values):
+        total_len = len(value)
+        upper_len = upper_lens[i]
+        lower_len = lower_lens[i]
+        compressed_len = get_compressed_len(encoded[i], compressor)
+        ret['ul_ratio'].append(None if lower_len == 0 else upper_len / lower_len)
+        ret['u_ratio'].append(None if total_len == 0 else upper_len / total_len)
+        ret['d_ratio'].append(None if total_len == 0 else digits_lens[i] / total_len)
+        ret['non_alnum_ratio'].append(None if total_len == 0 else (total_len - alnum_lens[i]) / total_len)
+        ret['compressibility'].append(None if compressed_len == 0 else total_len / compressed_len)
     return ret
 
 
+def get_compressed_len(data, compressor):
+    if compressor == 'lzw':
+        return len(list(lzw.compress(data)))
+    if compressor == 'zlib':
+        # raw deflate: without the zlib header and checksum, which would
+        # outweigh the data of short strings such as edit comments
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+        return len(compressor.compress(data)) + len(compressor.flush())
+    raise ValueError('Unknown compressor %r' % compressor)
+
+
+def char_table(chars):
+    """
+    Lookup table {byte: 1 if byte in chars else 0} as numpy array
+    """
+    table = np.zeros(256, dtype=np.int8)
+    table[[ord(c) for c in chars]] = 1
+    return table
+
+
+char_tables = []
+
+
+def get_char_tables():
+    """
+    Return lookup tables of uppercase, lowercase, digits and alphanumeric
+    characters, built on first use
+    """
+    if not char_tables:
+        char_tables.extend([char_table(string.ascii_uppercase),
+                            char_table(string.ascii_lowercase),
+                            char_table(string.digits),
+                            char_table(string.ascii_letters + string.digits)])
+    return char_tables
+
+
+# stages of the incremental pipeline, in order of execution. New features are
+# added by appending stages to the list
+pipeline = [cleanup,
+            extend_with_region_diff if DIFF_MODE == 'regions' else extend_with_diff,
+            extend_with_basic_text_metrics,
+            extend_with_ratio_metrics]
+
+
+# outputs of the stages which are not used as features directly
+text_fields = ['diff', 'neg_diff', 'urls', 'neg_urls', 'editcomment']
 
-uppercase = set(string.uppercase)
-lowercase = set(string.lowercase)
-digits = set(string.digits)
-alphanum = set(string.ascii_letters + string.digits)
+
+def get_feature_fields(functions=None):
+    """
+    Return the list of numeric (and boolean) outputs of the stages
+    """
+    fields = []
+    for func in functions or pipeline:
+        for field in func.outputs:
+            if field not in text_fields and field not in fields:
+                fields.append(field)
+    return fields
 
 
 def find_longest_seq(string):
@@ -336,46 +2281,323 @@ def find_longest_seq(string):
 
 #--- Wikipedia API helpers
 
-def api_request(action='query', **kw):
-    headers = {'User-Agent': 'AntiVandal Wikipedia API client (https://github.com/imankulov/pyconru2014)'}
+class HttpCache(object):
+    """
+    Two-tier cache of API responses: in-memory LRU in front of the httpcache
+    MongoDB collection.
+
+    Responses are stored in MongoDB as zlib-compressed JSON. Entries created
+    before compression was introduced (with the "val" field) are read as is.
+
+    Keys not found by `prefetch` are remembered until the next `get` or `set`
+    of the key, so that `get` doesn't query MongoDB for them again. Methods
+    can be called from several threads.
+
+    :param maxsize: max number of entries kept in memory
+    :param ttl: time to live of entries in seconds (0 for no expiration)
+    """
+
+    def __init__(self, collection=None, maxsize=None, ttl=None):
+        self.collection = collection
+        self.memory = LRUCache(HTTPCACHE_SIZE if maxsize is None else maxsize)
+        self.ttl = HTTPCACHE_TTL if ttl is None else ttl
+        self.stats = {'memory_hits': 0, 'db_hits': 0, 'misses': 0, 'expired': 0,
+                      'db_queries': 0, 'db_time': 0.0}
+        self.missing = set()
+        self.lock = threading.Lock()
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.stats[name] += value
+
+    def get(self, key):
+        """
+        Return the cached response, or None
+        """
+        entry = self.memory.get(key)
+        if entry is not None and not self.is_expired(entry):
+            self.count('memory_hits')
+            return entry[0]
+
+        with self.lock:
+            prefetched_missing = key in self.missing
+            self.missing.discard(key)
+        if prefetched_missing:
+            self.count('misses')
+            return None
+
+        start = time.time()
+        doc = self.get_collection().find_one({'key': key})
+        self.count('db_queries')
+        self.count('db_time', time.time() - start)
+
+        entry = doc and self.decode(doc)
+        if entry is None or self.is_expired(entry):
+            self.count('expired' if entry else 'misses')
+            self.memory.pop(key)
+            return None
+        self.count('db_hits')
+        self.memory.set(key, entry)
+        return entry[0]
+
+    def set(self, key, value):
+        ts = time.time()
+        doc = {'key': key, 'zval': binary_type()(zlib.compress(json.dumps(value))), 'ts': ts}
+        self.get_collection().update({'key': key}, doc, upsert=True)
+        self.memory.set(key, (value, ts))
+        with self.lock:
+            self.missing.discard(key)
+
+    def prefetch(self, keys, chunk_size=1000):
+        """
+        Load entries for several keys to memory with $in queries, and
+        remember the keys which are not found (or expired)
+        """
+        keys = [key for key in keys if key not in self.memory]
+        for chunk in iter_chunks(keys, chunk_size):
+            start = time.time()
+            docs = list(self.get_collection().find({'key': {'$in': chunk}}))
+            self.count('db_queries')
+            self.count('db_time', time.time() - start)
+            missing = set(chunk)
+            for doc in docs:
+                entry = self.decode(doc)
+                if not self.is_expired(entry):
+                    self.memory.set(doc['key'], entry)
+                    missing.discard(doc['key'])
+            with self.lock:
+                self.missing.update(missing)
+
+    def decode(self, doc):
+        """
+        Return the tuple (response, timestamp) for the cache document
+        """
+        if 'val' in doc:
+            return doc['val'], doc.get('ts')
+        return json.loads(zlib.decompress(doc['zval'])), doc['ts']
+
+    def is_expired(self, entry):
+        ts = entry[1]
+        return bool(self.ttl) and (ts is None or ts + self.ttl < time.time())
+
+    def get_collection(self):
+        return httpcache if self.collection is None else self.collection
+
+    def get_stats(self):
+        """
+        Return the dict of hit / miss counters, memory hit rate and average
+        latency of MongoDB queries
+        """
+        with self.lock:
+            stats = dict(self.stats)
+        total = stats['memory_hits'] + stats['db_hits'] + stats['misses'] + stats['expired']
+        stats['memory_size'] = len(self.memory)
+        stats['hit_rate'] = None if total == 0 else (stats['memory_hits'] + stats['db_hits']) / total
+        stats['memory_hit_rate'] = None if total == 0 else stats['memory_hits'] / total
+        stats['db_avg_time'] = None if stats['db_queries'] == 0 else stats['db_time'] / stats['db_queries']
+        return stats
+
+
+class ApiClient(object):
+    """
+    Wikipedia API client with a shared connection pool.
+
+    Requests can be issued concurrently from several threads (see `map` and
+    `request_many`). Concurrent requests with the same cache key are
+    coalesced: only one of them goes to the server, and the rest wait for its
+    result.
+
+    :param base_url: API endpoint, change it to test against a stub server
+    :param concurrency: number of threads and pooled connections
+    :param rate_limit: maximum number of requests per second (0 or None for no
+                       limit)
+    :param retries: number of retries on connection errors, 429 and 5xx
+                    responses, with exponential backoff
+    :param cache: HttpCache instance (by default a new one, configured with
+                  HTTPCACHE_* env variables)
+    """
+
+    user_agent = 'AntiVandal Wikipedia API client (https://github.com/imankulov/pyconru2014)'
+
+    def __init__(self, base_url=None, concurrency=None, rate_limit=None, retries=3,
+                 backoff=0.5, timeout=30, cache=None):
+        self.cache = cache or HttpCache()
+        self.base_url = base_url or WIKIPEDIA_API_URL
+        self.concurrency = concurrency or WIKIPEDIA_API_CONCURRENCY
+        self.rate_limit = WIKIPEDIA_API_RATE_LIMIT if rate_limit is None else rate_limit
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = self.user_agent
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=self.concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.next_request_time = 0
+
+    def request(self, action='query', **kw):
+        """
+        Make API request and return the decoded JSON response. Responses are
+        cached in the httpcache collection
+        """
+        params = get_api_params(action, **kw)
+        cache_key = get_cache_key(params)
+
+        with self.lock:
+            call = self.in_flight.get(cache_key)
+            owner = call is None
+            if owner:
+                call = self.in_flight[cache_key] = InFlightCall()
+        if not owner:
+            return call.wait()
+
+        try:
+            result = self.cache.get(cache_key)
+            if result is None:
+                result = self.fetch(params)
+                self.cache.set(cache_key, result)
+        except Exception as e:
+            call.set_exception(e)
+            raise
+        else:
+            call.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                del self.in_flight[cache_key]
+
+    def request_many(self, kwargs_list):
+        """
+        Make several requests concurrently. Accepts the list of dicts with
+        `request` keyword arguments and returns the list of responses
+        """
+        self.cache.prefetch([get_cache_key(get_api_params(**kwargs)) for kwargs in kwargs_list])
+        return self.map(lambda kwargs: self.request(**kwargs), kwargs_list)
+
+    def map(self, func, items):
+        """
+        Call func(item) for every item in the thread pool, return the list of
+        results. Use it to parallelize functions making requests
+        """
+        pool = ThreadPool(self.concurrency)
+        try:
+            return pool.map(func, items)
+        finally:
+            pool.close()
+            pool.join()
+
+    def fetch(self, params):
+        """
+        Send HTTP request to the server, bypassing the cache
+        """
+        attempt = 0
+        while True:
+            self.wait_rate_limit()
+            try:
+                resp = self.session.get(self.base_url, params=params, timeout=self.timeout)
+                if resp.status_code == 429 or resp.status_code >= 500:
+                    resp.raise_for_status()
+                return resp.json()
+            except (requests.ConnectionError, requests.Timeout, requests.HTTPError):
+                if attempt >= self.retries:
+                    raise
+            time.sleep(self.backoff * 2 ** attempt)
+            attempt += 1
+
+    def wait_rate_limit(self):
+        if not self.rate_limit:
+            return
+        with self.lock:
+            now = time.time()
+            delay = max(0, self.next_request_time - now)
+            self.next_request_time = max(now, self.next_request_time) + 1.0 / self.rate_limit
+        if delay:
+            time.sleep(delay)
+
+
+class InFlightCall(object):
+    """
+    Result of the request being made by another thread
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.exception = None
+
+    def set_result(self, result):
+        self.result = result
+        self.event.set()
+
+    def set_exception(self, exception):
+        self.exception = exception
+        self.event.set()
+
+    def wait(self):
+        self.event.wait()
+        if self.exception is not None:
+            raise self.exception
+        return self.result
+
+
+def get_api_params(action='query', **kw):
+    """
+    Return GET parameters for the API request
+    """
     kw.update(format='json')
-    base_url = 'http://en.wikipedia.org/w/api.php'
 
     # convert lists to mediawiki standart representation ("|"-separated string)
     for k, v in kw.items():
-        if isinstance(v, list):
+        if isinstance(v, (list, set, tuple)):
             kw[k] = '|'.join(v)
 
-    # GET parameters for HTTP request
-    params = dict(action=action, **kw)
+    return dict(action=action, **kw)
 
-    # cache hit
-    cache_key = urllib.urlencode(sorted(params.iteritems()))
-    cache_result = httpcache.find_one({'key': cache_key})
-    if cache_result:
-        return cache_result['val']
 
-    # cache miss
-    resp = requests.get(base_url, headers=headers, params=params)
-    json_resp = resp.json()
-    httpcache.insert({'key': cache_key, 'val': json_resp})
-    return json_resp
+def get_cache_key(params):
+    return urllib.urlencode(sorted(params.iteritems()))
 
 
-def get_page_revisions(page_id, revision_id):
+api_client = None
+
+
+def get_api_client():
+    """
+    Return the default API client, configured with WIKIPEDIA_API_* env
+    variables
     """
-    Get all page revisions, starting 1 Jan 2009 up to revision in question, in
-    reverse order (newer revisions first)
+    global api_client
+    if api_client is None:
+        api_client = ApiClient()
+    return api_client
+
+
+def api_request(action='query', **kw):
+    return get_api_client().request(action, **kw)
+
+
+def get_page_revisions(page_id, revision_id, end_revision_id=None,
+                       rvprop='ids|flags|timestamp|user|size'):
+    """
+    Get all page revisions, starting 1 Jan 2009 (or from `end_revision_id`)
+    up to revision in question, in reverse order (newer revisions first)
     """
     ret = []
     page_id = str(page_id)
-    rvend = datetime.datetime(2009, 1, 1).strftime('%s')
-    rvprop = 'ids|flags|timestamp|user|size'
     rvlimit = 500
     rvcontinue = None
     while True:
         kwargs = dict(prop='revisions', pageids=page_id, rvstartid=revision_id,
-                      rvend=rvend, rvprop=rvprop, rvlimit=rvlimit)
+                      rvprop=rvprop, rvlimit=rvlimit)
+        if end_revision_id is None:
+            kwargs['rvend'] = datetime.datetime(2009, 1, 1).strftime('%s')
+        else:
+            kwargs['rvendid'] = end_revision_id
         if rvcontinue is not None:
             kwargs['rvcontinue'] = rvcontinue
         resp = api_request(**kwargs)
@@ -386,26 +2608,281 @@ def get_page_revisions(page_id, revision_id):
     return ret
 
 
-def fill_editors_info():
+def get_pages_revisions(pairs):
+    """
+    Get revisions of several pages concurrently. Accepts the list of
+    (page_id, revision_id) tuples, returns the list of results of
+    `get_page_revisions`
+    """
+    return get_api_client().map(lambda pair: get_page_revisions(*pair), pairs)
+
+
+def fill_editors_info(batch_size=50, group_size=None, spec=None):
+    """
+    Fetch info of the registered editors of the corpus (or of the edits
+    matching the spec) from the API, and upsert it to the users collection by
+    name.
+
+    The distinct editors are found with one query, IP addresses and editors
+    already stored in users are skipped, so re-runs fetch only new editors.
+    Every request asks for `batch_size` users (the API limit is 50), and
+    `group_size` requests (the API client concurrency x 4 by default) are made
+    concurrently, while the users from the previous group are being written.
+    """
     usprop = 'blockinfo|groups|editcount|registration|emailable|gender'
+    client = get_api_client()
+    group_size = group_size or client.concurrency * 4
+
+    editors = {editor for editor in corpus.find(spec, fields=['editor']).distinct('editor')
+               if editor and not re_ip.match(editor)}
+    editors.difference_update(users.distinct('name'))
+    editors = sorted(editors)
+    batches = [editors[i:i + batch_size] for i in xrange(0, len(editors), batch_size)]
+
+    progress = tqdm(total=len(editors))
+    writer = BulkWriter(users)
+    write_pool = ThreadPool(1)
+    pending = None
+    try:
+        for group in iter_chunks(batches, group_size):
+            requests_kwargs = [dict(list='users', ususers=batch, usprop=usprop) for batch in group]
+            results = client.request_many(requests_kwargs)
+            if pending is not None:
+                pending.get()
+            pending = write_pool.apply_async(upsert_users, (writer, results))
+            progress.update(sum(len(batch) for batch in group))
+        if pending is not None:
+            pending.get()
+        writer.flush()
+    finally:
+        write_pool.close()
+        write_pool.join()
+    progress.close()
+
+
+def upsert_users(writer, results):
+    for result in results:
+        for user in result['query']['users']:
+            writer.upsert({'name': user['name']}, user)
+
+
+#--- Revision histories
+
+def update_histories(articles=None, group_size=None):
+    """
+    Fetch revision histories of the articles to the history collection. Every
+    article is fetched once, and later only the revisions newer than the
+    stored ones are fetched.
+
+    :param articles: dict {articleid: revision id}, the histories are fetched
+                     up to these revisions. By default, up to the newest
+                     revision of every article in the corpus
+    :param group_size: number of articles fetched concurrently before their
+                       revisions are written
+    """
+    client = get_api_client()
+    group_size = group_size or client.concurrency * 4
+    if articles is None:
+        articles = {}
+        for record in corpus.find({}, fields=['articleid', 'newrevisionid']):
+            articleid = record['articleid']
+            articles[articleid] = max(articles.get(articleid, 0), record['newrevisionid'])
+
+    stored = {}
+    for doc in history.find({}, fields=['articleid']):
+        stored[doc['articleid']] = max(stored.get(doc['articleid'], 0), doc['_id'])
+    tasks = [(articleid, revid, stored.get(articleid))
+             for articleid, revid in sorted(articles.iteritems())
+             if revid > stored.get(articleid, 0)]
+
+    def fetch(task):
+        articleid, revid, stored_revid = task
+        end_revid = None if stored_revid is None else stored_revid + 1
+        return articleid, get_page_revisions(articleid, revid, end_revid,
+                                             rvprop='ids|flags|timestamp|user|size|sha1')
+
+    progress = tqdm(total=len(tasks))
+    with BulkWriter(history) as writer:
+        for group in iter_chunks(tasks, group_size):
+            for articleid, page_revisions in client.map(fetch, group):
+                for revision in page_revisions:
+                    doc = get_history_doc(articleid, revision)
+                    writer.upsert({'_id': doc['_id']}, doc)
+            progress.update(len(group))
+    progress.close()
+
+
+def get_history_doc(articleid, revision):
+    """
+    Convert the revision returned by the API to the document of the history
+    collection
+    """
+    doc = {'_id': revision['revid'],
+           'articleid': articleid,
+           'parentid': revision.get('parentid'),
+           'user': revision.get('user'),
+           'anon': 'anon' in revision,
+           'minor': 'minor' in revision,
+           'size': revision.get('size'),
+           'sha1': revision.get('sha1'),
+           'timestamp': revision['timestamp']}
+    return to_timestamp(doc, 'timestamp')
+
+
+class ArticleHistory(object):
+    """
+    Revisions of the article as parallel lists sorted by revision id.
+    Timestamps are assumed to grow with revision ids
+    """
+
+    def __init__(self, docs):
+        docs = sorted(docs, key=lambda doc: doc['_id'])
+        self.revids = [doc['_id'] for doc in docs]
+        self.timestamps = [doc['timestamp'] for doc in docs]
+        self.users = [doc.get('user') for doc in docs]
+        self.anon = [doc.get('anon', False) for doc in docs]
+
+        # cumulative counts of anonymous edits and identity reverts (the
+        # revision has the same content as one of the earlier revisions
+        # except the previous one)
+        self.anon_cumsum = [0]
+        self.reverts_cumsum = [0]
+        seen = {}
+        for i, doc in enumerate(docs):
+            sha1 = doc.get('sha1')
+            revert = sha1 is not None and seen.get(sha1, i - 1) < i - 1
+            if sha1 is not None:
+                seen[sha1] = i
+            self.anon_cumsum.append(self.anon_cumsum[-1] + bool(self.anon[i]))
+            self.reverts_cumsum.append(self.reverts_cumsum[-1] + revert)
+
+    def __len__(self):
+        return len(self.revids)
+
+    def get_window(self, revid, days=None, timestamp=None):
+        """
+        Return (lo, hi) indices of the revisions before `revid` made within
+        `days` days before it. The time of the revision is `timestamp`, or,
+        if not given, the time of the revision `revid` (or of the latest one
+        before it, if it's not in the history)
+        """
+        hi = bisect.bisect_left(self.revids, revid)
+        if days is None:
+            return 0, hi
+        if timestamp is None:
+            if hi < len(self.revids) and self.revids[hi] == revid:
+                timestamp = self.timestamps[hi]
+            elif hi:
+                timestamp = self.timestamps[hi - 1]
+            else:
+                return 0, 0
+        lo = bisect.bisect_left(self.timestamps, timestamp - days * 86400, 0, hi)
+        return lo, hi
+
+    def revisions_before(self, revid, days=None, timestamp=None):
+        """
+        Return the list of dicts {revid, timestamp, user, anon} of the
+        revisions before `revid` within `days` days, older revisions first
+        """
+        lo, hi = self.get_window(revid, days, timestamp)
+        return [{'revid': self.revids[i],
+                 'timestamp': self.timestamps[i],
+                 'user': self.users[i],
+                 'anon': self.anon[i]}
+                for i in xrange(lo, hi)]
+
+    def get_features(self, revid, editor, days=30, timestamp=None):
+        """
+        Return history features of the edit making the revision `revid`
+        """
+        lo, hi = self.get_window(revid, days, timestamp)
+        count = hi - lo
+        if timestamp is None and hi < len(self.revids) and self.revids[hi] == revid:
+            timestamp = self.timestamps[hi]
+        return {
+            'hist_edits': count,
+            'hist_edits_per_day': count / days,
+            'hist_anon_share': None if not count else
+                (self.anon_cumsum[hi] - self.anon_cumsum[lo]) / count,
+            'hist_reverts': self.reverts_cumsum[hi] - self.reverts_cumsum[lo],
+            'hist_editor_edits': sum(1 for i in xrange(lo, hi) if self.users[i] == editor),
+            'hist_since_last': None if not hi or timestamp is None else
+                timestamp - self.timestamps[hi - 1],
+        }
+
+
+class RevisionHistory(object):
+    """
+    In-memory index of article histories, loaded from the history collection
+    on demand. Up to `maxsize` least recently used articles are kept
+    """
 
-    cursor = corpus.find({}, fields=['editor'])
-    seen = set()
+    def __init__(self, collection=None, maxsize=None):
+        self.collection = collection or history
+        self.cache = LRUCache(HISTORY_CACHE_SIZE if maxsize is None else maxsize)
+
+    def load(self, articleids):
+        """
+        Load histories of the articles, return the dict {articleid:
+        ArticleHistory} (empty histories for articles not fetched yet)
+        """
+        ret = {}
+        missing = []
+        for articleid in set(articleids):
+            article = self.cache.get(articleid)
+            if article is None:
+                missing.append(articleid)
+            else:
+                ret[articleid] = article
+        if missing:
+            docs = {articleid: [] for articleid in missing}
+            for doc in self.collection.find({'articleid': {'$in': missing}}):
+                docs[doc['articleid']].append(doc)
+            for articleid, article_docs in docs.iteritems():
+                ret[articleid] = ArticleHistory(article_docs)
+                self.cache.set(articleid, ret[articleid])
+        return ret
+
+    def get(self, articleid):
+        return self.load([articleid])[articleid]
+
+    def revisions_before(self, articleid, revid, days=None):
+        return self.get(articleid).revisions_before(revid, days)
+
+
+revision_history = None
 
-    current = set()
-    for record in tqdm(cursor, total=corpus.count()):
-        editor = record['editor']
-        if re_ip.match(editor) or editor in seen:
-            continue
-        current.add(editor)
-        if len(current) >= 50:
-            seen.update(current)
-            result = api_request(list='users', ususers=current, usprop=usprop)
-            users.insert(result['query']['users'])
-            current = set()
-    if current:
-        result = api_request(list='users', ususers=current, usprop=usprop)
-        users.insert(result['query']['users'])
+
+def get_revision_history():
+    global revision_history
+    if revision_history is None:
+        revision_history = RevisionHistory()
+    return revision_history
+
+
+history_days = 30
+
+
+@stage(inputs=['articleid', 'newrevisionid', 'editor', 'edittime'],
+       outputs=['hist_edits', 'hist_edits_per_day', 'hist_anon_share', 'hist_reverts',
+                'hist_editor_edits', 'hist_since_last'])
+def extend_with_history(**record):
+    """
+    Article history features of the edit, computed from the history
+    collection (see `update_histories`) over `history_days` days before the
+    edit. Not included to the default pipeline, as histories have to be
+    fetched first. The fingerprint doesn't depend on the fetched histories,
+    so apply it with incremental=False after fetching more of them
+    """
+    return extend_with_history_batch([record])[0]
+
+
+@batched(extend_with_history)
+def extend_with_history_batch(records):
+    articles = get_revision_history().load(record['articleid'] for record in records)
+    return [articles[record['articleid']].get_features(
+                record['newrevisionid'], record['editor'], history_days, record.get('edittime'))
+            for record in records]
 
 
 #--- Converters
@@ -423,34 +2900,65 @@ def to_timestamp(obj, *keys):
 
 #--- Utils
 
+def tokenize_keep_urls(text):
+    """
+    Split the text to chunks with nltk.word_tokenize, keeping urls as single
+    chunks. Return the tuple (list of chunks, set of urls)
+    """
+    text, preprocessor_map = keep_urls_preprocess(text)
+    chunks = keep_urls_postprocess(nltk.word_tokenize(text), preprocessor_map)
+    return chunks, set(preprocessor_map.itervalues())
+
+
 def keep_urls_preprocess(text):
+    """
+    Replace urls in the text with word-alike placeholders, which
+    nltk.word_tokenize never splits. Return the tuple (new text, {placeholder:
+    url})
+    """
     preprocessor_map = {}
     rev_preprocessor_map = {}
     def _preprocessor(match):
         url = match.group(0)
-        if url in rev_preprocessor_map:
-            repl = rev_preprocessor_map[url]
-        else:
-            repl = magic + ''.join(random.sample(string.ascii_lowercase, 1)[0] for _ in xrange(16))
+        repl = rev_preprocessor_map.get(url)
+        if repl is None:
+            repl = url_placeholder(len(preprocessor_map))
             preprocessor_map[repl] = url
             rev_preprocessor_map[url] = repl
         return repl
     return re_http_url.sub(_preprocessor, text), preprocessor_map
 
 
+def url_placeholder(n):
+    """
+    Return the placeholder for the n-th url of the text: magic prefix followed
+    by n written as 16 lowercase letters (base 26)
+    """
+    letters = []
+    for _ in xrange(16):
+        n, r = divmod(n, 26)
+        letters.append(string.ascii_lowercase[r])
+    return magic + ''.join(letters)
+
+
 def keep_urls_postprocess(chunks, preprocessor_map):
-    #ret = []
-    #for chunk in chunks:
-    #    if chunk in preprocessor_map:
-    #        chunk = preprocessor_map[chunk]
-    #    ret.append(chunk)
+    """
+    Replace placeholders in chunks back with urls. Only the chunks with the
+    magic prefix are inspected, and all placeholders of the chunk are replaced
+    in one pass with a regex.
+    """
+    if not preprocessor_map:
+        return list(chunks)
+
+    def _postprocessor(match):
+        placeholder = match.group(0)
+        return preprocessor_map.get(placeholder, placeholder)
 
-    # Slow but rubust algorithm
     ret = []
     for chunk in chunks:
-        for key, value in preprocessor_map.iteritems():
-            chunk = chunk.replace(key, value)
         if magic in chunk:
-            raise RuntimeError('Postprocess function failed')
+            chunk = re_url_placeholder.sub(_postprocessor, chunk)
+            if magic in chunk:
+                raise RuntimeError('Postprocess function failed')
         ret.append(chunk)
     return ret
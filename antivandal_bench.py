@@ -0,0 +1,465 @@
+"""
+Benchmarks of the antivandal pipeline.
+
+Results are printed and optionally saved as JSON, so that runs on different
+commits can be compared::
+
+    python antivandal_bench.py startup --repeat 10 --output startup.json
+    python antivandal_bench.py stages --output stages.json
+    python antivandal_bench.py corpus --storage sqlite:///tmp/bench.db mongodb://localhost/bench
+    python antivandal_bench.py scoring --limit 2000 --rate 200
+
+The stages and corpus benchmarks run offline on synthetic data generated
+from a fixed seed. Every benchmark case runs in a separate worker process, so
+that peak memory (growth of the peak resident set size during the case) is
+measured independently. Results kept in memory by the memoization caches
+(see `antivandal.MemoCache`) are dropped before every measured run, which
+would otherwise only look them up.
+"""
+from __future__ import division
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+from collections import OrderedDict
+from antivandal import (get_memory_usage, reset_peak_memory, print_results, save_results,
+                        clear_memo_caches)
+
+
+#--- Startup
+
+startup_modules = ['antivandal', 'antivandal_export']
+
+
+def bench_startup(modules=None, repeat=10):
+    """
+    Measure the import time of the modules, each import in a fresh
+    interpreter (the interpreter start itself is measured separately as
+    'python' and is included in the other timings)
+
+    :param modules: names of the modules to import
+    :param repeat: number of runs per module
+    :return: {module: {'min': seconds, 'median': seconds, 'max': seconds,
+                       'modules_loaded': number of modules in sys.modules}}
+    """
+    results = OrderedDict()
+    for name in [None] + list(modules or startup_modules):
+        code = 'import sys\n'
+        if name is not None:
+            code += 'import %s\n' % name
+        code += 'sys.stdout.write(str(len(sys.modules)))'
+        timings = []
+        loaded = None
+        for _ in xrange(repeat):
+            start = time.time()
+            loaded = int(subprocess.check_output([sys.executable, '-c', code],
+                                                 cwd=os.path.dirname(os.path.abspath(__file__))))
+            timings.append(time.time() - start)
+        timings.sort()
+        results[name or 'python'] = {'min': timings[0],
+                                     'median': timings[len(timings) // 2],
+                                     'max': timings[-1],
+                                     'modules_loaded': loaded}
+    return results
+
+
+#--- Synthetic data
+
+bench_words = [u'the', u'of', u'and', u'in', u'a', u'is', u'was', u'to', u'by',
+               u'Wikipedia', u'article', u'History', u'population', u'river',
+               u'city', u'North', u'census', u'ACME', u'1999', u'2010', u'42',
+               u"''bold''", u'[[Link]]', u'{{cite', u'web}}', u'==Section==',
+               u'<ref>', u'</ref>', u'|', u'infobox', u'lol', u'LOL!!!']
+
+
+def make_text(rng, size, url_density=0.01):
+    """
+    Return the random wiki-like text of approximately `size` characters.
+    `url_density` is the share of words which are urls
+    """
+    chunks = []
+    length = 0
+    while length < size:
+        if rng.random() < url_density:
+            word = u'http://www.example%d.com/page/%d' % (rng.randint(0, 999), rng.randint(0, 99999))
+        else:
+            word = rng.choice(bench_words)
+        chunks.append(word)
+        chunks.append(u'\n' if rng.random() < 0.08 else u' ')
+        length += len(word) + 1
+    return u''.join(chunks)
+
+
+def make_revision_pair(rng, size=10000, url_density=0.01, edit_size=200):
+    """
+    Return (old revision, new revision): the new revision has a random region
+    of about `edit_size` characters replaced with a new text of the same size
+    """
+    old = make_text(rng, size, url_density)
+    pos = rng.randint(0, max(0, len(old) - edit_size))
+    new = old[:pos] + make_text(rng, edit_size, url_density) + old[pos + edit_size // 2:]
+    return old, new
+
+
+def make_edits(count, size=10000, url_density=0.01, edit_size=200, seed=1234):
+    """
+    Return the list of synthetic records with revisions and comments
+    """
+    rng = random.Random(seed)
+    edits = []
+    for i in xrange(count):
+        oldrevision, newrevision = make_revision_pair(rng, size, url_density, edit_size)
+        edits.append({'_id': i,
+                      'editid': i,
+                      'oldrevision': oldrevision,
+                      'newrevision': newrevision,
+                      'editcomment': make_text(rng, rng.randint(0, 60), url_density)})
+    return edits
+
+
+#--- Stages
+
+def get_stage_cases():
+    """
+    Return the dict {name: (prepare, run)} of the stage benchmarks: `prepare`
+    turns synthetic records to the input of `run` (not measured), `run`
+    processes the input
+    """
+    import antivandal as av
+
+    def with_diff(edits):
+        return av.extend_records(edits, [av.extend_with_diff])
+
+    def tokenized(edits):
+        items = []
+        for edit in edits:
+            text, preprocessor_map = av.keep_urls_preprocess(edit['newrevision'])
+            items.append((av.nltk.word_tokenize(text), preprocessor_map))
+        return items
+
+    return OrderedDict([
+        ('keep_urls_preprocess',
+         (None, lambda edits: [av.keep_urls_preprocess(e['newrevision']) for e in edits])),
+        ('keep_urls_postprocess',
+         (tokenized, lambda items: [av.keep_urls_postprocess(c, m) for c, m in items])),
+        ('extend_with_diff',
+         (None, lambda edits: [av.extend_with_diff(**e) for e in edits])),
+        ('extend_with_region_diff',
+         (None, lambda edits: [av.extend_with_region_diff(**e) for e in edits])),
+        ('extend_with_basic_text_metrics',
+         (None, lambda edits: [av.extend_with_basic_text_metrics(**e) for e in edits])),
+        ('extend_with_ratio_metrics',
+         (with_diff, av.extend_with_ratio_metrics_batch)),
+        ('find_longest_seq',
+         (None, lambda edits: [av.find_longest_seq(e['newrevision']) for e in edits])),
+    ])
+
+
+def measure(func):
+    """
+    Call the function, return (elapsed seconds, peak memory growth in MB)
+    """
+    reset_peak_memory()
+    rss, _ = get_memory_usage()
+    start = time.time()
+    func()
+    elapsed = time.time() - start
+    return elapsed, get_memory_usage()[1] - rss
+
+
+def run_isolated(func, *args):
+    """
+    Run the function in a new worker process and return its result
+    """
+    pool = multiprocessing.Pool(1)
+    try:
+        return pool.apply(func, args)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def run_stage_case(name, count, size, url_density, edit_size, repeat):
+    prepare, run = get_stage_cases()[name]
+    edits = make_edits(count, size, url_density, edit_size)
+    input_bytes = sum(len(e['oldrevision']) + len(e['newrevision']) for e in edits)
+    data = prepare(edits) if prepare else edits
+    # warm up: lazy imports, lookup tables, regexes
+    run(data[:1])
+
+    results = []
+    for _ in xrange(repeat):
+        # every run computes token sets and metrics instead of reusing the
+        # results of the previous one
+        clear_memo_caches()
+        results.append(measure(lambda: run(data)))
+    timings, memory = zip(*results)
+    elapsed = min(timings)
+    return {'seconds': elapsed,
+            'records_per_second': count / elapsed,
+            'mb_per_second': input_bytes / elapsed / (1 << 20),
+            'peak_memory_mb': max(memory)}
+
+
+def get_stage_params(sizes, url_densities, edit_sizes):
+    """
+    Vary one parameter at a time, the others are fixed at their first values
+    """
+    params = []
+    for values, i in [(sizes, 0), (url_densities, 1), (edit_sizes, 2)]:
+        for value in values:
+            p = [sizes[0], url_densities[0], edit_sizes[0]]
+            p[i] = value
+            if p not in params:
+                params.append(p)
+    return params
+
+
+def bench_stages(stages=None, sizes=(10000, 1000, 100000), url_densities=(0.01, 0, 0.1),
+                 edit_sizes=(200, 20, 2000), total_size=1 << 21, repeat=3):
+    """
+    Measure throughput and peak memory of the feature extraction stages on
+    synthetic revision pairs.
+
+    :param stages: names of the stages (see `get_stage_cases`), all by default
+    :param sizes: revision sizes, in characters
+    :param url_densities: shares of words which are urls
+    :param edit_sizes: sizes of the changed regions, in characters
+    :param total_size: total size of old revisions of every case, the number
+                       of revision pairs is total_size / size
+    :param repeat: number of runs of every case, the fastest one is reported
+    :return: {"stage size=N urls=N edit=N": {'seconds', 'records_per_second',
+             'mb_per_second', 'peak_memory_mb'}}
+    """
+    results = OrderedDict()
+    for name in stages or get_stage_cases():
+        for size, url_density, edit_size in get_stage_params(sizes, url_densities, edit_sizes):
+            count = max(10, total_size // size)
+            key = '%s size=%d urls=%g edit=%d' % (name, size, url_density, edit_size)
+            results[key] = run_isolated(run_stage_case, name, count, size, url_density,
+                                        edit_size, repeat)
+    return results
+
+
+#--- Fixture corpus
+
+def make_fixture_corpus(directory, count=500, size=5000, url_density=0.01, edit_size=200,
+                        articles=50, seed=1234):
+    """
+    Write the synthetic corpus in the layout of PAN-WVC-11 to the directory:
+    `count` edits of `articles` articles, every edit changes the latest
+    revision of its article
+    """
+    rng = random.Random(seed)
+    topdir = os.path.join(directory, 'pan-wikipedia-vandalism-corpus-2011')
+    revdir = os.path.join(topdir, 'article-revisions-en', 'part1')
+    os.makedirs(revdir)
+
+    def write_revision(revid, text):
+        with open(os.path.join(revdir, '%d.txt' % revid), 'w') as f:
+            f.write(text.encode('utf8'))
+
+    latest = {}
+    next_revid = 1
+    for articleid in xrange(articles):
+        latest[articleid] = (next_revid, make_text(rng, size, url_density))
+        write_revision(*latest[articleid])
+        next_revid += 1
+
+    with open(os.path.join(topdir, 'edits-en.csv'), 'w') as f:
+        f.write('editid,editor,oldrevisionid,newrevisionid,diffurl,edittime,editcomment,'
+                'articleid,articletitle,class,annotators,totalannotators\n')
+        for editid in xrange(count):
+            articleid = rng.randrange(articles)
+            oldrevid, old = latest[articleid]
+            pos = rng.randint(0, max(0, len(old) - edit_size))
+            new = old[:pos] + make_text(rng, edit_size, url_density) + old[pos + edit_size // 2:]
+            latest[articleid] = (next_revid, new)
+            write_revision(next_revid, new)
+            f.write('%d,editor%d,%d,%d,http://en.wikipedia.org/,2011-01-01T00:00:%02dZ,'
+                    'comment %d,%d,Article %d,%s,1,1\n'
+                    % (editid, rng.randrange(100), oldrevid, next_revid, editid % 60,
+                       editid, articleid, articleid,
+                       'vandalism' if rng.random() < 0.1 else 'regular'))
+            next_revid += 1
+
+
+def run_corpus_case(storage_url, directory, embed_revisions):
+    import antivandal as av
+    os.chdir(directory)
+    av.STORAGE_URL = storage_url
+    av.connect()
+    for collection in [av.corpus, av.revisions, av.httpcache, av.users, av.memocache]:
+        collection.remove({})
+    av.ensure_index()
+    count = sum(1 for _ in open('pan-wikipedia-vandalism-corpus-2011/edits-en.csv')) - 1
+
+    steps = [('import', lambda: av.import_corpus_2011(embed_revisions=embed_revisions)),
+             ('apply_all', lambda: av.apply_all()),
+             ('apply_all (no changes)', lambda: av.apply_all()),
+             ('export_collection', lambda: av.export_collection('bench.csv', collection=av.corpus)),
+             ('export_collections', lambda: av.export_collections(
+                 [('dataset.csv', ['editid', 'editor', 'editcomment', 'vandalism']),
+                  ('metainfo.csv', ['editid', 'diff', 'neg_diff', 'diff_u_ratio'])],
+                 collection=av.corpus))]
+    results = OrderedDict()
+    for name, step in steps:
+        elapsed, memory = measure(step)
+        results[name] = {'seconds': elapsed,
+                         'records_per_second': count / elapsed,
+                         'peak_memory_mb': memory}
+    return results
+
+
+def bench_corpus(storage_urls=None, count=500, embed_revisions=True):
+    """
+    Import the synthetic fixture corpus, apply the pipeline and export the
+    corpus with every storage, measuring throughput and peak memory of every
+    step.
+
+    All collections of the storages are cleared, so use dedicated
+    databases. By default a temporary SQLite database is used
+    """
+    directory = tempfile.mkdtemp(prefix='antivandal_bench')
+    try:
+        make_fixture_corpus(directory, count)
+        results = OrderedDict()
+        for url in storage_urls or ['sqlite://' + os.path.join(directory, 'bench.db')]:
+            for step, result in run_isolated(run_corpus_case, url, directory, embed_revisions).iteritems():
+                results['%s %s' % (url.split(':')[0], step)] = result
+        return results
+    finally:
+        shutil.rmtree(directory)
+
+
+#--- Scoring
+
+def load_stream(limit=1000):
+    """
+    Load the edits of the stored corpus (with revision contents) in the order
+    of edit time, as they would arrive from the live stream
+    """
+    from antivandal import corpus, load_record_revisions
+    fields = ['editid', 'editor', 'editcomment', 'edittime', 'vandalism',
+              'oldrevisionid', 'newrevisionid']
+    edits = list(corpus.find(fields=fields).sort('edittime', 1).limit(limit))
+    load_record_revisions(edits)
+    return edits
+
+
+def replay(service, edits, rate=0):
+    """
+    Submit the edits to the scoring service at the given rate (edits per
+    second, 0 for as fast as possible) and wait for all the scores.
+
+    Return (elapsed seconds, list of latencies in seconds)
+    """
+    start = time.time()
+    calls = []
+    for i, edit in enumerate(edits):
+        if rate:
+            delay = start + i / rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        calls.append(service.submit(edit))
+    for call in calls:
+        call.wait()
+    return time.time() - start, [call.latency for call in calls]
+
+
+def get_percentiles(values, percentiles=(50, 95, 99, 100)):
+    values = sorted(values)
+    return {'p%d' % p: values[min(len(values) - 1, int(len(values) * p / 100))]
+            for p in percentiles}
+
+
+def bench_scoring(model_filename=None, limit=1000, batch_sizes=(1, 8, 32), max_delay=None, rate=0):
+    """
+    Replay the stored corpus as the stream of edits through the scoring
+    service.
+
+    :param model_filename: model saved by `Scorer.save`. If not given, the
+                           model is trained on the replayed edits
+    :param limit: number of edits to replay
+    :param batch_sizes: maximum micro-batch sizes to compare
+    :param max_delay: maximum time to wait for the micro-batch to fill
+    :param rate: edits per second, 0 to submit as fast as possible
+    :return: {'batch_size=N': {'throughput': edits per second,
+                               'p50'...'p100': latency in milliseconds,
+                               'batches': number of batches}}
+    """
+    from antivandal_service import Scorer, ScoringService, fit_model, prepare_edit
+    from antivandal import extend_records, pipeline
+
+    edits = load_stream(limit)
+    if model_filename:
+        scorer = Scorer.load(model_filename)
+    else:
+        records = extend_records([prepare_edit(edit) for edit in edits], pipeline)
+        scorer = fit_model(records)
+
+    # warm up: lazy imports, lookup tables
+    scorer.score_batch(edits[:10])
+
+    results = OrderedDict()
+    for batch_size in batch_sizes:
+        # the same edits are replayed for every batch size
+        clear_memo_caches()
+        with ScoringService(scorer, batch_size, max_delay) as service:
+            elapsed, latencies = replay(service, edits, rate)
+        result = {k: v * 1000 for k, v in get_percentiles(latencies).iteritems()}
+        result['throughput'] = len(edits) / elapsed
+        result['batches'] = service.batches
+        results['batch_size=%d' % batch_size] = result
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    subparsers = parser.add_subparsers(dest='benchmark')
+    startup = subparsers.add_parser('startup', help='import time of the modules')
+    startup.add_argument('--repeat', type=int, default=10)
+    startup.add_argument('--modules', nargs='+', default=startup_modules)
+    stages = subparsers.add_parser('stages', help='feature extraction stages on synthetic revisions')
+    stages.add_argument('--stages', nargs='+')
+    stages.add_argument('--sizes', type=int, nargs='+', default=[10000, 1000, 100000])
+    stages.add_argument('--url-densities', type=float, nargs='+', default=[0.01, 0, 0.1])
+    stages.add_argument('--edit-sizes', type=int, nargs='+', default=[200, 20, 2000])
+    stages.add_argument('--total-size', type=int, default=1 << 21)
+    stages.add_argument('--repeat', type=int, default=3)
+    corpus = subparsers.add_parser('corpus', help='import, apply and export of the fixture corpus')
+    corpus.add_argument('--storage', nargs='+', help='storage URLs, temporary SQLite by default')
+    corpus.add_argument('--count', type=int, default=500)
+    corpus.add_argument('--revision-store', action='store_true',
+                        help='keep revisions in the revision store instead of the corpus')
+    scoring = subparsers.add_parser('scoring', help='latency and throughput of the scoring service')
+    scoring.add_argument('--model', help='model file, trained on the replayed edits if not given')
+    scoring.add_argument('--limit', type=int, default=1000)
+    scoring.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 8, 32])
+    scoring.add_argument('--max-delay', type=float)
+    scoring.add_argument('--rate', type=float, default=0)
+    for subparser in subparsers.choices.values():
+        subparser.add_argument('--output', help='save results to this JSON file')
+    args = parser.parse_args(argv)
+
+    if args.benchmark == 'startup':
+        results = bench_startup(args.modules, args.repeat)
+    elif args.benchmark == 'stages':
+        results = bench_stages(args.stages, args.sizes, args.url_densities, args.edit_sizes,
+                               args.total_size, args.repeat)
+    elif args.benchmark == 'corpus':
+        results = bench_corpus(args.storage, args.count, not args.revision_store)
+    elif args.benchmark == 'scoring':
+        results = bench_scoring(args.model, args.limit, args.batch_sizes, args.max_delay, args.rate)
+    print_results(results)
+    if args.output:
+        save_results(args.output, args.benchmark, results)
+
+
+if __name__ == '__main__':
+    main()
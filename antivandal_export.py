@@ -1,10 +1,17 @@
+import os
+import json
 import time
-import numpy as np
-import pandas as pd
-from antivandal import export_collection, users
+import zlib
+from antivandal import (LazyModule, export_collection, export_collections, users, corpus,
+                        iter_chunks, tqdm, get_feature_fields)
+
+np = LazyModule('numpy')
+pd = LazyModule('pandas')
+sparse = LazyModule('scipy.sparse')
 
 
 base_fields = [
+    u'ds',
     u'editid',
 
     u'articleid',
@@ -20,6 +27,7 @@ base_fields = [
 
 
 meta_fields = [
+    u'ds',
     u'editid',
 
     u'blanking',
@@ -61,10 +69,27 @@ def timestamp_converter(v):
         return int(time.mktime(time.strptime(v, '%Y-%m-%dT%H:%M:%SZ')))
 
 
-def export():
-    export_collection('dataset.csv', include=base_fields)
-    export_collection('metainfo.csv', include=meta_fields)
-    export_collection('users.csv',
+def export(fmt='csv'):
+    """
+    Export the dataset, metainfo and users tables.
+
+    :param fmt: "csv" or "parquet"
+    """
+    export_collections(get_corpus_outputs(fmt))
+    export_users(fmt)
+
+
+def get_corpus_outputs(fmt='csv'):
+    """
+    Return the list of (filename, fields) tuples of the tables exported from
+    the corpus
+    """
+    return [('dataset.' + fmt, base_fields),
+            ('metainfo.' + fmt, meta_fields)]
+
+
+def export_users(fmt='csv'):
+    export_collection('users.' + fmt,
                       collection=users,
                       include=['editcount', 'gender', 'groups', 'name', 'registration'],
                       converters={
@@ -80,8 +105,18 @@ def export():
     )
 
 
-def split_dataset():
-    dataset = pd.read_csv('dataset.csv').sort('editid')
+def read_table(filename):
+    """
+    Read the exported table to pandas DataFrame. Parquet files are loaded
+    without parsing the text
+    """
+    if filename.endswith('.parquet'):
+        return pd.read_parquet(filename)
+    return pd.read_csv(filename)
+
+
+def split_dataset(filename='dataset.csv'):
+    dataset = read_table(filename).sort('editid')
     idx_train, idx_test = split_idx(dataset.shape[0])
 
     # we don't want put "vandalism" result to the test dataset
@@ -95,8 +130,269 @@ def split_dataset():
     dataset.iloc[idx_test].to_csv('test.csv', index=False, cols=dataset_test_columns)
 
     # export expected test results
-    dataset.iloc[idx_test].to_csv('solution.csv', index=False, cols=['editid', 'vandalism'])
+    dataset.iloc[idx_test].to_csv('solution.csv', index=False, cols=get_solution_columns(dataset))
+
+
+
+def split_dataset_streaming(filename='dataset.csv', p=0.5, seed=1234, stratify=False,
+                            chunk_size=100000):
+    """
+    Split the dataset to train.csv, test.csv and solution.csv in one pass with
+    bounded memory.
+
+    Every row goes to the train dataset if the hash of its editid (see
+    `hash_fraction`) is less than `p`, so the split is reproducible without
+    a global shuffle. Unlike `split_dataset`, rows keep the order of the
+    source file.
+
+    :param stratify: if True, the dataset is read once more beforehand (only
+                     editid and vandalism columns) to find per-class hash
+                     thresholds, so that exactly the share `p` of vandalism
+                     and regular edits goes to the train dataset
+    """
+    thresholds = None
+    if stratify:
+        thresholds = get_stratified_thresholds(filename, p, seed, chunk_size)
+
+    files = [open(name, 'w') for name in ['train.csv', 'test.csv', 'solution.csv']]
+    train_fd, test_fd, solution_fd = files
+    try:
+        header = True
+        for chunk in read_table_chunks(filename, chunk_size):
+            fractions = hash_fraction(chunk['editid'].values, seed)
+            if thresholds is None:
+                is_train = fractions < p
+            else:
+                is_train = fractions < chunk['vandalism'].map(thresholds).values
+
+            test_columns = [c for c in chunk.columns if c != 'vandalism']
+            chunk[is_train].to_csv(train_fd, index=False, header=header)
+            chunk[~is_train].to_csv(test_fd, index=False, header=header, columns=test_columns)
+            chunk[~is_train].to_csv(solution_fd, index=False, header=header,
+                                    columns=get_solution_columns(chunk))
+            header = False
+    finally:
+        for fd in files:
+            fd.close()
+
+
+def get_solution_columns(dataset):
+    # tables exported before "ds" was added have editid only
+    return [c for c in ['ds', 'editid', 'vandalism'] if c in dataset.columns]
+
+
+def get_stratified_thresholds(filename, p, seed, chunk_size):
+    """
+    Return the dict {vandalism: hash threshold}, such that share `p` of rows
+    of every class has the hash of editid below the threshold
+    """
+    fractions = {}
+    for chunk in read_table_chunks(filename, chunk_size, columns=['editid', 'vandalism']):
+        chunk_fractions = hash_fraction(chunk['editid'].values, seed)
+        for cls in chunk['vandalism'].unique():
+            mask = (chunk['vandalism'] == cls).values
+            fractions.setdefault(cls, []).append(chunk_fractions[mask])
+
+    thresholds = {}
+    for cls, cls_fractions in fractions.items():
+        cls_fractions = np.sort(np.concatenate(cls_fractions))
+        t = int(len(cls_fractions) * p)
+        thresholds[cls] = cls_fractions[t] if t < len(cls_fractions) else 1.0
+    return thresholds
+
+
+def read_table_chunks(filename, chunk_size, columns=None):
+    """
+    Iterate over the exported table by DataFrame chunks. Parquet files are
+    read by row groups
+    """
+    if filename.endswith('.parquet'):
+        import pyarrow.parquet
+        parquet_file = pyarrow.parquet.ParquetFile(filename)
+        for i in range(parquet_file.num_row_groups):
+            yield parquet_file.read_row_group(i, columns=columns).to_pandas()
+    else:
+        for chunk in pd.read_csv(filename, chunksize=chunk_size, usecols=columns):
+            yield chunk
+
+
+def hash_fraction(ids, seed):
+    """
+    Map the array of integer ids to deterministic pseudo-random numbers in
+    [0, 1) with the splitmix64 hash function
+    """
+    with np.errstate(over='ignore'):
+        x = ids.astype(np.uint64) + np.uint64(seed) * np.uint64(0x9E3779B97F4A7C15)
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        x = x ^ (x >> np.uint64(31))
+    return (x >> np.uint64(11)).astype(np.float64) / float(1 << 53)
+
+
+#--- Feature matrix
+
+# fields with space-joined tokens, hashed to the columns of the sparse matrix
+token_fields = ['diff', 'neg_diff', 'urls', 'neg_urls']
+
+
+def export_features(directory='features', n_features=1 << 20, chunk_size=10000):
+    """
+    Build the feature matrix of the corpus in one pass, and save it to the
+    directory as raw binary arrays, which are memory-mapped by
+    `load_features`:
+
+    - tokens of `token_fields` are hashed (crc32 of "field:token") to
+      `n_features` columns of the sparse CSR matrix (data.bin, indices.bin,
+      indptr.bin), so that no vocabulary has to be collected beforehand
+    - numeric outputs of the pipeline stages are saved to the dense matrix
+      dense.bin (float64, NaN for missing values)
+    - rows are ordered by (ds, editid), which are saved to ds.bin and
+      editid.bin
+
+    Shapes and dtypes are saved to meta.json
+    """
+    dense_columns = get_feature_fields()
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    names = ['ds', 'editid', 'data', 'indices', 'indptr', 'dense']
+    files = {name: open(os.path.join(directory, name + '.bin'), 'wb') for name in names}
+    rows = 0
+    nnz = 0
+    try:
+        files['indptr'].write(np.zeros(1, dtype=np.int64).tostring())
+        cursor = corpus.find(fields=['ds', 'editid'] + token_fields + dense_columns)
+        cursor = cursor.sort([('ds', 1), ('editid', 1)])
+        progress = tqdm(total=corpus.count())
+        for records in iter_chunks(cursor, chunk_size):
+            indices, indptr = hash_tokens(records, n_features, nnz)
+            files['ds'].write(np.array([r.get('ds') or 0 for r in records], dtype=np.int32).tostring())
+            files['editid'].write(np.array([r['editid'] for r in records], dtype=np.int64).tostring())
+            files['data'].write(np.ones(len(indices), dtype=np.float32).tostring())
+            files['indices'].write(indices.tostring())
+            files['indptr'].write(indptr.tostring())
+            files['dense'].write(get_dense_matrix(records, dense_columns).tostring())
+            rows += len(records)
+            nnz += len(indices)
+            progress.update(len(records))
+        progress.close()
+    finally:
+        for f in files.values():
+            f.close()
+
+    meta = {'rows': rows,
+            'nnz': nnz,
+            'n_features': n_features,
+            'token_fields': token_fields,
+            'dense_columns': dense_columns,
+            'dtypes': {'ds': 'int32', 'editid': 'int64', 'data': 'float32',
+                       'indices': 'int32', 'indptr': 'int64', 'dense': 'float64'}}
+    with open(os.path.join(directory, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+
+
+def hash_tokens(records, n_features, offset=0):
+    """
+    Return (column indices, row ends) of the hashed tokens of the records,
+    row ends are shifted by `offset` (number of values in previous chunks).
+    Colliding tokens of the same row are merged
+    """
+    indices = []
+    indptr = []
+    for record in records:
+        columns = set()
+        for field in token_fields:
+            prefix = field + ':'
+            for token in (record.get(field) or u'').split(u' '):
+                if token:
+                    columns.add((zlib.crc32((prefix + token).encode('utf8')) & 0xffffffff) % n_features)
+        indices.extend(sorted(columns))
+        indptr.append(offset + len(indices))
+    return np.array(indices, dtype=np.int32), np.array(indptr, dtype=np.int64)
+
+
+def get_dense_matrix(records, columns):
+    X = np.empty((len(records), len(columns)), dtype=np.float64)
+    for i, record in enumerate(records):
+        for j, column in enumerate(columns):
+            value = record.get(column)
+            X[i, j] = np.nan if value is None else value
+    return X
+
+
+def load_features(directory='features'):
+    """
+    Load the feature matrix saved by `export_features`. Arrays are
+    memory-mapped, so loading takes no time, and only the pages being used
+    are read from disk.
+
+    Return the dict with keys:
+
+    - ds, editid: arrays identifying the rows
+    - tokens: scipy.sparse.csr_matrix of hashed tokens
+    - dense: 2-dimensional array of numeric features
+    - dense_columns: names of the columns of the dense array
+    """
+    with open(os.path.join(directory, 'meta.json')) as f:
+        meta = json.load(f)
+    rows = meta['rows']
+
+    def load(name, shape=None):
+        filename = os.path.join(directory, name + '.bin')
+        if os.path.getsize(filename) == 0:
+            return np.zeros(shape or 0, dtype=meta['dtypes'][name])
+        return np.memmap(filename, dtype=meta['dtypes'][name], mode='r', shape=shape)
+
+    indices = load('indices')
+    indptr = load('indptr')
+    if meta['nnz'] < 2 ** 31:
+        # scipy would otherwise upcast (copy) indices to the dtype of indptr
+        indptr = indptr.astype(np.int32)
+    tokens = sparse.csr_matrix((load('data'), indices, indptr),
+                               shape=(rows, meta['n_features']), copy=False)
+    return {'ds': load('ds'),
+            'editid': load('editid'),
+            'tokens': tokens,
+            'dense': load('dense', shape=(rows, len(meta['dense_columns']))),
+            'dense_columns': meta['dense_columns']}
+
+
+def select_rows(features, editids, ds=None):
+    """
+    Return the features of the given edits (in the given order), e.g. to
+    align them with the exported train or test dataset.
 
+    :param ds: dataset (2010 or 2011) of the edits, a single value or an array
+               with a value per edit. Required if the features were built
+               from the corpus with both datasets
+    """
+    editids = np.asarray(editids, dtype=np.int64)
+    all_ds = features['ds']
+    rows = np.zeros(len(editids), dtype=np.int64)
+    found = np.zeros(len(editids), dtype=bool)
+    if ds is None:
+        if len(all_ds) and all_ds[0] != all_ds[-1]:
+            raise ValueError('ds is required, features contain several datasets')
+        groups = [(slice(None), 0, len(all_ds))]
+    else:
+        ds = np.broadcast_to(np.asarray(ds, dtype=np.int64), editids.shape)
+        # rows are sorted by ds, then by editid
+        groups = [(ds == value,) + tuple(np.searchsorted(all_ds, [value, value + 1]))
+                  for value in np.unique(ds)]
+    for mask, lo, hi in groups:
+        all_editids = features['editid'][lo:hi]
+        group_rows = np.searchsorted(all_editids, editids[mask])
+        group_found = group_rows < len(all_editids)
+        group_found[group_found] = all_editids[group_rows[group_found]] == editids[mask][group_found]
+        rows[mask] = group_rows + lo
+        found[mask] = group_found
+    if not found.all():
+        raise KeyError('Edits not found in the feature matrix: %s' % editids[~found][:10].tolist())
+    return {'ds': features['ds'][rows],
+            'editid': features['editid'][rows],
+            'tokens': features['tokens'][rows],
+            'dense': features['dense'][rows],
+            'dense_columns': features['dense_columns']}
 
 
 def split_idx(dataset_length, p=0.5, seed=1234):
@@ -0,0 +1,433 @@
+#!/usr/bin/env python
+"""
+Sharded jobs: processing of the corpus by any number of workers.
+
+The job splits the corpus to shards, the ranges of edit ids within every
+dataset source (ds), and keeps them in the jobs collection of the storage
+(MONGODB_JOBS_COLLECTION). Workers, in any number of processes on any number
+of nodes sharing the storage, claim the shards one by one with a lease, process
+them and mark them done:
+
+    python antivandal_jobs.py create features apply --shard-size 5000
+    python antivandal_jobs.py worker features     # on every node
+    python antivandal_jobs.py status features
+
+or, with several local worker processes:
+
+    python antivandal_jobs.py local features --processes 4
+
+Job kinds:
+
+- apply: run the pipeline stages (`apply_all`, or the `--functions` given)
+  over the shard
+- editors: fill editors info (`fill_editors_info`) of the shard edits
+- export: export the dataset and metainfo tables (csv) of the shard to part
+  files, which are joined by `finish` once all shards are done. Part files are
+  written next to the tables, so the workers must share the directory
+
+The lease of the running shard is renewed in the background while the worker
+is alive. A shard whose lease expired (the worker crashed or was killed) is
+claimed again by another worker, and a shard whose processing failed is put
+back to the queue, up to ANTIVANDAL_JOB_MAX_ATTEMPTS attempts. The processing
+of every shard is idempotent, so the results are the same as of a single-node
+run, whichever workers processed the shards and how many times.
+"""
+from __future__ import division
+import os
+import time
+import shutil
+import socket
+import argparse
+import threading
+import traceback
+import multiprocessing
+from collections import Counter
+import antivandal
+from antivandal import (corpus, jobs, connect, pipeline, apply, fill_editors_info,
+                        export_collections)
+from antivandal_export import get_corpus_outputs, export_users
+
+
+JOB_LEASE = float(os.environ.get('ANTIVANDAL_JOB_LEASE', 300))  # seconds
+JOB_MAX_ATTEMPTS = int(os.environ.get('ANTIVANDAL_JOB_MAX_ATTEMPTS', 3))
+JOB_POLL_INTERVAL = float(os.environ.get('ANTIVANDAL_JOB_POLL_INTERVAL', 5))  # seconds
+
+
+#--- Shards
+
+def create_job(job, kind, shard_size=10000, spec=None, **params):
+    """
+    Split the corpus (or the records matching the spec) to shards of up to
+    `shard_size` edits and add them to the jobs collection as pending.
+
+    :param job: name of the job
+    :param kind: "apply", "editors" or "export"
+    :param params: parameters of the job kind, see the `run_*_shard`
+                   functions
+    :return: number of shards
+    """
+    if kind not in job_kinds:
+        raise ValueError('Unknown job kind: %s' % kind)
+    if jobs.find_one({'job': job}) is not None:
+        raise ValueError('Job %r already exists' % job)
+    shards = [{'job': job,
+               'kind': kind,
+               'params': params,
+               'ds': ds,
+               'lo': lo,
+               'hi': hi,
+               'count': count,
+               'state': 'pending',
+               'attempts': 0}
+              for ds, lo, hi, count in get_shard_ranges(shard_size, spec)]
+    if shards:
+        jobs.insert(shards)
+    return len(shards)
+
+
+def get_shard_ranges(shard_size, spec=None):
+    """
+    Split the corpus to (ds, lo, hi, count) tuples, each of them covering up
+    to `shard_size` edits of the dataset source with `lo <= editid <= hi`
+    """
+    for ds in sorted(corpus.find(spec, fields=['ds']).distinct('ds')):
+        cursor = corpus.find(dict(spec or {}, ds=ds), fields=['editid'])
+        editids = sorted(record['editid'] for record in cursor)
+        for i in xrange(0, len(editids), shard_size):
+            chunk = editids[i:i + shard_size]
+            yield ds, chunk[0], chunk[-1], len(chunk)
+
+
+def get_shard_spec(shard):
+    return {'ds': shard['ds'], 'editid': {'$gte': shard['lo'], '$lte': shard['hi']}}
+
+
+def claim_shard(job, worker, lease=None, max_attempts=None):
+    """
+    Atomically take the pending shard of the job (or the running one whose
+    lease expired) for the worker. Return the shard, or None if there are no
+    shards to take
+    """
+    lease = lease or JOB_LEASE
+    max_attempts = max_attempts or JOB_MAX_ATTEMPTS
+    now = time.time()
+    update = {'$set': {'state': 'running', 'owner': worker, 'lease_until': now + lease,
+                       'started': now},
+              '$inc': {'attempts': 1}}
+    for spec in [{'job': job, 'state': 'pending'},
+                 {'job': job, 'state': 'running', 'lease_until': {'$lt': now},
+                  'attempts': {'$lt': max_attempts}}]:
+        shard = jobs.find_and_modify(spec, update, sort=[('_id', 1)], new=True)
+        if shard is not None:
+            return shard
+
+
+def renew_lease(shard, worker, lease=None):
+    jobs.update({'_id': shard['_id'], 'owner': worker, 'state': 'running'},
+                {'$set': {'lease_until': time.time() + (lease or JOB_LEASE)}})
+
+
+def complete_shard(shard, worker, result=None):
+    """
+    Mark the shard done. Does nothing if the worker lost the shard (its lease
+    expired and another worker took it)
+    """
+    jobs.update({'_id': shard['_id'], 'owner': worker, 'state': 'running'},
+                {'$set': {'state': 'done', 'finished': time.time(), 'result': result or {}},
+                 '$unset': {'error': 1}})
+
+
+def fail_shard(shard, worker, error, max_attempts=None):
+    """
+    Put the shard back to the queue, or mark it failed after `max_attempts`
+    attempts
+    """
+    max_attempts = max_attempts or JOB_MAX_ATTEMPTS
+    state = 'pending' if shard['attempts'] < max_attempts else 'failed'
+    jobs.update({'_id': shard['_id'], 'owner': worker, 'state': 'running'},
+                {'$set': {'state': state, 'finished': time.time(), 'error': error}})
+
+
+def fail_expired(job, max_attempts=None):
+    """
+    Mark failed the running shards whose lease expired after the last allowed
+    attempt
+    """
+    max_attempts = max_attempts or JOB_MAX_ATTEMPTS
+    spec = {'job': job, 'state': 'running', 'lease_until': {'$lt': time.time()},
+            'attempts': {'$gte': max_attempts}}
+    update = {'$set': {'state': 'failed', 'error': 'Lease expired'}}
+    while jobs.find_and_modify(spec, update) is not None:
+        pass
+
+
+def retry_failed(job):
+    """
+    Put the failed shards of the job back to the queue, return their number
+    """
+    n = 0
+    update = {'$set': {'state': 'pending', 'attempts': 0}}
+    while jobs.find_and_modify({'job': job, 'state': 'failed'}, update) is not None:
+        n += 1
+    return n
+
+
+def delete_job(job):
+    jobs.remove({'job': job})
+
+
+def get_job_status(job):
+    """
+    Return the dict with the number of shards and edits by state, and the
+    errors of the failed shards
+    """
+    shards = Counter()
+    edits = Counter()
+    errors = []
+    for shard in jobs.find({'job': job}, fields=['state', 'count', 'ds', 'lo', 'hi', 'error']):
+        shards[shard['state']] += 1
+        edits[shard['state']] += shard['count']
+        if shard['state'] == 'failed':
+            errors.append((shard['ds'], shard['lo'], shard['hi'], shard.get('error')))
+    return {'shards': dict(shards), 'edits': dict(edits), 'errors': errors}
+
+
+#--- Workers
+
+def get_worker_name():
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+def run_worker(job, worker=None, lease=None, max_attempts=None, poll_interval=None):
+    """
+    Process the shards of the job until all of them are done or failed.
+    Return the number of shards processed by the worker
+    """
+    worker = worker or get_worker_name()
+    poll_interval = JOB_POLL_INTERVAL if poll_interval is None else poll_interval
+    processed = 0
+    while True:
+        shard = claim_shard(job, worker, lease, max_attempts)
+        if shard is None:
+            fail_expired(job, max_attempts)
+            if jobs.find_one({'job': job, 'state': {'$in': ['pending', 'running']}}) is None:
+                break
+            # shards taken by other workers, wait for them to finish (or to
+            # expire)
+            time.sleep(poll_interval)
+            continue
+        process_shard(shard, worker, lease, max_attempts)
+        processed += 1
+    return processed
+
+
+def process_shard(shard, worker, lease=None, max_attempts=None):
+    keeper = LeaseKeeper(shard, worker, lease)
+    try:
+        result = job_kinds[shard['kind']](shard)
+    except Exception:
+        keeper.stop()
+        fail_shard(shard, worker, traceback.format_exc(), max_attempts)
+    else:
+        keeper.stop()
+        complete_shard(shard, worker, result)
+
+
+class LeaseKeeper(object):
+    """
+    Renews the lease of the shard in the background thread until stopped
+    """
+
+    def __init__(self, shard, worker, lease=None):
+        self.shard = shard
+        self.worker = worker
+        self.lease = lease or JOB_LEASE
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.lease / 3):
+            renew_lease(self.shard, self.worker, self.lease)
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+def run_local(job, processes=None, **kwargs):
+    """
+    Run `processes` workers (the number of CPUs by default) of the job in
+    local processes, wait for them to finish and return the job status
+    """
+    processes = processes or multiprocessing.cpu_count()
+    workers = [multiprocessing.Process(target=run_worker_process, args=(job, kwargs))
+               for _ in xrange(processes)]
+    for process in workers:
+        process.start()
+    for process in workers:
+        process.join()
+    return get_job_status(job)
+
+
+def run_worker_process(job, kwargs):
+    # connections must not be shared across fork()
+    connect()
+    run_worker(job, **kwargs)
+
+
+#--- Job kinds
+
+job_kinds = {}
+
+
+def job_kind(name):
+    """
+    Decorator registering the function processing the shards of the job kind.
+    The function accepts the shard document and returns the dict of results
+    """
+    def decorator(func):
+        job_kinds[name] = func
+        return func
+    return decorator
+
+
+@job_kind('apply')
+def run_apply_shard(shard):
+    """
+    Parameters: "functions" (names of the functions of antivandal module, the
+    pipeline by default), "incremental" (true by default) and "chunk_size"
+    """
+    params = shard['params']
+    names = params.get('functions') or [func.__name__ for func in pipeline]
+    functions = [getattr(antivandal, name) for name in names]
+    spec = get_shard_spec(shard)
+    apply(*functions, spec=spec, incremental=params.get('incremental', True),
+          chunk_size=params.get('chunk_size', 1000))
+    return {'records': corpus.find(spec).count()}
+
+
+@job_kind('editors')
+def run_editors_shard(shard):
+    """
+    Parameters: "batch_size", see `fill_editors_info`
+    """
+    fill_editors_info(batch_size=shard['params'].get('batch_size', 50),
+                      spec=get_shard_spec(shard))
+    return {}
+
+
+@job_kind('export')
+def run_export_shard(shard):
+    outputs = [(get_part_filename(filename, shard), fields)
+               for filename, fields in get_corpus_outputs()]
+    export_collections(outputs, spec=get_shard_spec(shard))
+    return {'files': [filename for filename, _ in outputs]}
+
+
+def get_part_filename(filename, shard):
+    base, ext = os.path.splitext(filename)
+    return '%s.part-%s-%s%s' % (base, shard['ds'], shard['lo'], ext)
+
+
+def finish_export(job):
+    """
+    Join the part files of the export job to the tables, in the order of the
+    shards (by ds and edit id), and export the users table.
+    Raises RuntimeError if not all shards are done.
+
+    The tables have the same rows as the ones of `antivandal_export.export`,
+    which follow the order of insertion instead (the same, unless some edits
+    were re-imported)
+    """
+    status = get_job_status(job)
+    if set(status['shards']) - {'done'}:
+        raise RuntimeError('Not all shards are done: %r' % status['shards'])
+    shards = sorted(jobs.find({'job': job}, fields=['ds', 'lo']),
+                    key=lambda shard: (shard['ds'], shard['lo']))
+    for filename, _ in get_corpus_outputs():
+        parts = [get_part_filename(filename, shard) for shard in shards]
+        join_csv_files(filename, parts)
+        for part in parts:
+            os.remove(part)
+    export_users()
+
+
+def join_csv_files(filename, parts):
+    """
+    Concatenate csv files with the same header, keeping the header of the
+    first one. Empty files are skipped
+    """
+    header = None
+    with open(filename, 'wb') as out:
+        for part in parts:
+            with open(part, 'rb') as f:
+                line = f.readline()
+                if not line:
+                    continue
+                if header is None:
+                    header = line
+                    out.write(line)
+                elif line != header:
+                    raise ValueError('Header of %s differs from %s' % (part, parts[0]))
+                shutil.copyfileobj(f, out)
+
+
+def print_status(job):
+    status = get_job_status(job)
+    for state in ['pending', 'running', 'done', 'failed']:
+        print '%-8s %6d shards %9d edits' % (state, status['shards'].get(state, 0),
+                                               status['edits'].get(state, 0))
+    for ds, lo, hi, error in status['errors']:
+        print
+        print 'ds=%s editid=%s..%s' % (ds, lo, hi)
+        print error
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    subparsers = parser.add_subparsers(dest='command')
+    create = subparsers.add_parser('create', help='split the corpus to shards of the new job')
+    create.add_argument('job', help='job name')
+    create.add_argument('kind', choices=sorted(job_kinds))
+    create.add_argument('--shard-size', type=int, default=10000)
+    create.add_argument('--functions', nargs='+', help='functions to apply, the pipeline by default')
+    create.add_argument('--full', action='store_true', help='apply all functions, not incrementally')
+    worker = subparsers.add_parser('worker', help='process shards of the job')
+    local = subparsers.add_parser('local', help='process shards of the job with local processes')
+    local.add_argument('--processes', type=int)
+    for subparser in [worker, local]:
+        subparser.add_argument('--lease', type=float)
+        subparser.add_argument('--max-attempts', type=int)
+    status = subparsers.add_parser('status', help='number of shards by state and errors')
+    retry = subparsers.add_parser('retry', help='put the failed shards back to the queue')
+    finish = subparsers.add_parser('finish', help='join the part files of the export job')
+    delete = subparsers.add_parser('delete', help='delete the shards of the job')
+    for subparser in [worker, local, status, retry, finish, delete]:
+        subparser.add_argument('job', help='job name')
+    args = parser.parse_args(argv)
+
+    if args.command == 'create':
+        params = {}
+        if args.kind == 'apply':
+            params = {'functions': args.functions, 'incremental': not args.full}
+        print '%d shards' % create_job(args.job, args.kind, args.shard_size, **params)
+    elif args.command == 'worker':
+        print '%d shards processed' % run_worker(args.job, lease=args.lease,
+                                                 max_attempts=args.max_attempts)
+    elif args.command == 'local':
+        run_local(args.job, args.processes, lease=args.lease, max_attempts=args.max_attempts)
+        print_status(args.job)
+    elif args.command == 'status':
+        print_status(args.job)
+    elif args.command == 'retry':
+        print '%d shards' % retry_failed(args.job)
+    elif args.command == 'finish':
+        finish_export(args.job)
+    elif args.command == 'delete':
+        delete_job(args.job)
+
+
+if __name__ == '__main__':
+    main()
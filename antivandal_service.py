@@ -0,0 +1,231 @@
+"""
+Real-time scoring of Wikipedia edits.
+
+Edits arriving from the live stream are scored in memory: the features are
+computed by the same stages as in the offline pipeline (see
+`antivandal.pipeline`), without any storage access, and fed to the model
+trained offline::
+
+    scorer = Scorer.load('model.pkl')
+    with ScoringService(scorer) as service:
+        score = service.score({'oldrevision': u'...', 'newrevision': u'...',
+                               'editcomment': u'...', 'editor': u'...'})
+
+`ScoringService` collects concurrently submitted edits to micro-batches (up
+to ANTIVANDAL_SCORING_BATCH_SIZE edits, waiting not longer than
+ANTIVANDAL_SCORING_MAX_DELAY seconds for the batch to fill), so that the batch
+implementations of the stages and the model are called once per batch.
+
+For the tightest latency, use ANTIVANDAL_DIFF_MODE=regions: only the changed
+regions of revisions are tokenized. The model must be trained with the same
+diff mode and compressor, as they change feature values.
+"""
+from __future__ import division
+import os
+import time
+import pickle
+import threading
+import Queue
+from antivandal import (LazyModule, InFlightCall, pipeline, extend_records, get_feature_fields,
+                        COMPRESSOR, DIFF_MODE)
+
+np = LazyModule('numpy')
+linear_model = LazyModule('sklearn.linear_model')
+
+
+SCORING_MODEL = os.environ.get('ANTIVANDAL_SCORING_MODEL', 'model.pkl')
+SCORING_BATCH_SIZE = int(os.environ.get('ANTIVANDAL_SCORING_BATCH_SIZE', 32))
+SCORING_MAX_DELAY = float(os.environ.get('ANTIVANDAL_SCORING_MAX_DELAY', 0.005))
+
+
+def get_feature_matrix(records, features):
+    """
+    Return the feature matrix (numpy array of float64) of the records. Missing
+    values (e.g. ratios of empty strings) are 0
+    """
+    X = np.zeros((len(records), len(features)), dtype=np.float64)
+    for i, record in enumerate(records):
+        for j, field in enumerate(features):
+            value = record.get(field)
+            if value is not None:
+                X[i, j] = value
+    return X
+
+
+def prepare_edit(edit):
+    """
+    Return the record for the edit: revisions and comment as unicode
+    strings, other fields (editor, editid, ...) are kept as is
+    """
+    record = dict(edit)
+    for field in ['oldrevision', 'newrevision', 'editcomment']:
+        value = record.get(field) or u''
+        if isinstance(value, str):
+            value = value.decode('utf8')
+        record[field] = value
+    return record
+
+
+def fit_model(records, features=None, model=None):
+    """
+    Train the model on the records with computed features and "vandalism"
+    labels.
+
+    :param features: feature fields, all numeric outputs of the pipeline by
+                     default
+    :param model: estimator with `fit` and `predict_proba` methods,
+                  logistic regression by default
+    :return: Scorer
+    """
+    features = features or get_feature_fields()
+    model = model or linear_model.LogisticRegression(solver='liblinear')
+    X = get_feature_matrix(records, features)
+    y = np.array([bool(record['vandalism']) for record in records])
+    model.fit(X, y)
+    return Scorer(model, features)
+
+
+class Scorer(object):
+    """
+    Computes the features of the edits in memory and scores them with the
+    model. Score is the probability of vandalism
+    """
+
+    def __init__(self, model, features, functions=None):
+        self.model = model
+        self.features = features
+        self.functions = functions or pipeline
+
+    @classmethod
+    def load(cls, filename=None):
+        """
+        Load the model saved by `save`. Raises ValueError if the model was
+        trained with a different compressor or diff mode
+        """
+        with open(filename or SCORING_MODEL, 'rb') as f:
+            data = pickle.load(f)
+        for key, value in [('compressor', COMPRESSOR), ('diff_mode', DIFF_MODE)]:
+            if data[key] != value:
+                raise ValueError('Model was trained with %s=%r, current is %r' % (key, data[key], value))
+        return cls(data['model'], data['features'])
+
+    def save(self, filename=None):
+        data = {'model': self.model,
+                'features': self.features,
+                'compressor': COMPRESSOR,
+                'diff_mode': DIFF_MODE}
+        with open(filename or SCORING_MODEL, 'wb') as f:
+            pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+
+    def score_batch(self, edits):
+        """
+        Return the list of scores of the edits
+        """
+        if not edits:
+            return []
+        records = extend_records([prepare_edit(edit) for edit in edits], self.functions)
+        X = get_feature_matrix(records, self.features)
+        return self.model.predict_proba(X)[:, 1].tolist()
+
+    def score(self, edit):
+        return self.score_batch([edit])[0]
+
+
+class ScoringCall(InFlightCall):
+    """
+    Score of the submitted edit, with submit and finish times
+    """
+
+    def __init__(self, edit):
+        super(ScoringCall, self).__init__()
+        self.edit = edit
+        self.submitted = time.time()
+        self.finished = None
+
+    @property
+    def latency(self):
+        return None if self.finished is None else self.finished - self.submitted
+
+
+class ScoringService(object):
+    """
+    Scores the edits submitted from any number of threads in micro-batches,
+    in the background thread
+    """
+
+    def __init__(self, scorer, batch_size=None, max_delay=None):
+        self.scorer = scorer
+        self.batch_size = batch_size or SCORING_BATCH_SIZE
+        self.max_delay = SCORING_MAX_DELAY if max_delay is None else max_delay
+        self.queue = Queue.Queue()
+        self.batches = 0
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def submit(self, edit):
+        """
+        Submit the edit for scoring, return ScoringCall
+        """
+        call = ScoringCall(edit)
+        self.queue.put(call)
+        return call
+
+    def score(self, edit):
+        return self.submit(edit).wait()
+
+    def score_many(self, edits):
+        calls = [self.submit(edit) for edit in edits]
+        return [call.wait() for call in calls]
+
+    def close(self):
+        """
+        Score the edits submitted so far and stop the background thread
+        """
+        self.queue.put(None)
+        self.thread.join()
+
+    def run(self):
+        stopped = False
+        while not stopped:
+            call = self.queue.get()
+            if call is None:
+                break
+            batch = [call]
+            deadline = time.time() + self.max_delay
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.time()
+                try:
+                    if timeout > 0:
+                        call = self.queue.get(timeout=timeout)
+                    else:
+                        # don't wait any more, but take what is already queued
+                        call = self.queue.get_nowait()
+                except Queue.Empty:
+                    break
+                if call is None:
+                    stopped = True
+                    break
+                batch.append(call)
+            self.process(batch)
+
+    def process(self, batch):
+        try:
+            scores = self.scorer.score_batch([call.edit for call in batch])
+        except Exception as e:
+            finished = time.time()
+            for call in batch:
+                call.finished = finished
+                call.set_exception(e)
+        else:
+            finished = time.time()
+            for call, score in zip(batch, scores):
+                call.finished = finished
+                call.set_result(score)
+        self.batches += 1
@@ -0,0 +1,509 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Storage backends for antivandal.
+
+The storage is selected by the URL:
+
+- mongodb://host:port/database: MongoDB server (the default)
+- sqlite:///path/to/file.db: embedded SQLite database, no server required
+
+Collections of every backend implement the subset of pymongo 2.x Collection
+API used by antivandal:
+
+- find(spec=None, fields=None, sort=None): cursor with sort(), limit(),
+  count() and distinct() methods
+- find_one(spec=None, fields=None, sort=None)
+- count()
+- distinct(key)
+- insert(doc_or_docs)
+- update(spec, document, upsert=False): replacement document, or update
+  document with $set, $unset and $inc operators
+- find_and_modify(query=None, update=None, sort=None, new=False)
+- remove(spec=None)
+- ensure_index(keys, unique=False, name=None)
+- initialize_unordered_bulk_op(): bulk builder with find(spec).update_one(),
+  find(spec).upsert().replace_one() and execute() methods
+
+Query specs support equality and $in, $gt, $gte, $lt, $lte, $ne and $exists
+operators, sort and projection work on top-level fields only.
+"""
+import re
+import json
+import base64
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+
+def open_storage(url):
+    """
+    Return the storage for the URL
+    """
+    if url.startswith('sqlite://'):
+        return SqliteStorage(url[len('sqlite://'):])
+    if url.startswith('mongodb://'):
+        return MongoStorage(url)
+    raise ValueError('Unknown storage URL: %s' % url)
+
+
+class MongoStorage(object):
+    """
+    MongoDB storage, collections are pymongo collections
+    """
+
+    def __init__(self, url):
+        import pymongo
+        self.client = pymongo.MongoClient(url)
+        self.db = self.client.get_default_database()
+
+    def collection(self, name):
+        return self.db[name]
+
+    def close(self):
+        self.client.close()
+
+
+#--- SQLite
+
+
+class SqliteStorage(object):
+    """
+    Embedded SQLite storage.
+
+    Every collection is a table with the integer primary key "_id" and the
+    JSON-encoded document. Queries and indexes use json_extract expressions,
+    so SQLite 3.38+ (or older with the JSON1 extension) is required. The
+    connection is shared by all threads and guarded by the lock.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.lock = threading.RLock()
+        self.depth = 0
+
+    def collection(self, name):
+        return SqliteCollection(self, name)
+
+    def close(self):
+        self.conn.close()
+
+    def execute(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Run statements in a transaction. Nested transactions are merged to
+        the outermost one
+        """
+        with self.lock:
+            self.depth += 1
+            try:
+                if self.depth == 1:
+                    # take the write lock at once: a deferred transaction
+                    # upgrading its read lock fails if another process has
+                    # written meanwhile
+                    self.conn.execute('BEGIN IMMEDIATE')
+                try:
+                    yield self.conn
+                except:
+                    if self.depth == 1:
+                        self.conn.execute('ROLLBACK')
+                    raise
+                else:
+                    if self.depth == 1:
+                        self.conn.execute('COMMIT')
+            finally:
+                self.depth -= 1
+
+
+re_field = re.compile(r'^\w+$')
+
+comparison_operators = {'$gt': '>', '$gte': '>=', '$lt': '<', '$lte': '<='}
+
+
+def field_expr(field):
+    """
+    SQL expression extracting the field from the document
+    """
+    if field == '_id':
+        return '_id'
+    if not re_field.match(field):
+        raise ValueError('Unsupported field name: %r' % field)
+    return "json_extract(doc, '$.%s')" % field
+
+
+def encode_value(value):
+    """
+    Prepare the value for JSON encoding: binary strings are stored as
+    {"$binary": base64 string}
+    """
+    if isinstance(value, binary_type()):
+        return {'$binary': base64.b64encode(value)}
+    if isinstance(value, dict):
+        return {k: encode_value(v) for k, v in value.iteritems()}
+    if isinstance(value, (list, tuple)):
+        return [encode_value(v) for v in value]
+    return value
+
+
+def decode_object(obj):
+    if len(obj) == 1 and '$binary' in obj:
+        return binary_type()(base64.b64decode(obj['$binary']))
+    return obj
+
+
+class Binary(str):
+    """
+    Binary string, used instead of bson Binary if bson is not installed
+    """
+
+
+_binary_type = None
+
+
+def binary_type():
+    """
+    Return bson Binary type (imported on first use), or `Binary` if bson is
+    not installed. Both are str subclasses, so binary values are read as is
+    (e.g. by zlib.decompress) with any storage
+    """
+    global _binary_type
+    if _binary_type is None:
+        try:
+            from bson.binary import Binary as _binary_type
+        except ImportError:
+            _binary_type = Binary
+    return _binary_type
+
+
+def dumps(value):
+    return json.dumps(encode_value(value), separators=(',', ':'))
+
+
+def loads(text):
+    return json.loads(text, object_hook=decode_object)
+
+
+class SqliteCollection(object):
+
+    page_size = 1000
+
+    def __init__(self, storage, name):
+        if not re_field.match(name):
+            raise ValueError('Unsupported collection name: %r' % name)
+        self.storage = storage
+        self.name = name
+        self.table = '"%s"' % name
+        storage.execute('CREATE TABLE IF NOT EXISTS %s '
+                        '(_id INTEGER PRIMARY KEY, doc TEXT NOT NULL)' % self.table)
+
+    #--- reading
+
+    def find(self, spec=None, fields=None, sort=None):
+        cursor = SqliteCursor(self, spec, fields)
+        if sort is not None:
+            cursor.sort(sort)
+        return cursor
+
+    def find_one(self, spec=None, fields=None, sort=None):
+        for doc in self.find(spec, fields=fields, sort=sort).limit(1):
+            return doc
+
+    def count(self):
+        return self.find().count()
+
+    def distinct(self, key):
+        return self.find().distinct(key)
+
+    def where(self, spec):
+        """
+        Translate the query spec to the tuple (WHERE clause, params)
+        """
+        clauses = []
+        params = []
+        for key, cond in (spec or {}).iteritems():
+            expr = field_expr(key)
+            if not (isinstance(cond, dict) and cond and all(k.startswith('$') for k in cond)):
+                cond = {'$eq': cond}
+            for op, value in cond.iteritems():
+                if op == '$eq' and value is None:
+                    clauses.append('%s IS NULL' % expr)
+                elif op == '$eq':
+                    clauses.append('%s = ?' % expr)
+                    params.append(value)
+                elif op == '$ne':
+                    clauses.append('%s IS NOT ?' % expr)
+                    params.append(value)
+                elif op == '$in':
+                    clauses.append('%s IN (SELECT value FROM json_each(?))' % expr)
+                    params.append(dumps(list(value)))
+                elif op in comparison_operators:
+                    clauses.append('%s %s ?' % (expr, comparison_operators[op]))
+                    params.append(value)
+                elif op == '$exists':
+                    type_expr = expr.replace('json_extract', 'json_type')
+                    clauses.append('%s IS %s NULL' % (type_expr, 'NOT' if value else ''))
+                else:
+                    raise ValueError('Unsupported query operator: %s' % op)
+        if not clauses:
+            return '', []
+        return 'WHERE ' + ' AND '.join(clauses), params
+
+    def find_ids(self, spec, limit=None):
+        where, params = self.where(spec)
+        sql = 'SELECT _id FROM %s %s ORDER BY _id' % (self.table, where)
+        if limit is not None:
+            sql += ' LIMIT %d' % limit
+        return [row[0] for row in self.storage.execute(sql, params)]
+
+    #--- writing
+
+    def insert(self, doc_or_docs):
+        docs = doc_or_docs if isinstance(doc_or_docs, list) else [doc_or_docs]
+        with self.storage.transaction() as conn:
+            for doc in docs:
+                data = {k: v for k, v in doc.iteritems() if k != '_id'}
+                cursor = conn.execute('INSERT INTO %s (_id, doc) VALUES (?, ?)' % self.table,
+                                      (doc.get('_id'), dumps(data)))
+                doc['_id'] = cursor.lastrowid
+        if isinstance(doc_or_docs, list):
+            return [doc['_id'] for doc in docs]
+        return doc_or_docs['_id']
+
+    def update(self, spec, document, upsert=False):
+        with self.storage.transaction() as conn:
+            ids = self.find_ids(spec, limit=1)
+            if any(k.startswith('$') for k in document):
+                if ids:
+                    self.apply_update(conn, ids[0], document)
+                elif upsert:
+                    doc = {k: v for k, v in (spec or {}).iteritems() if not isinstance(v, dict)}
+                    doc.update(document.get('$set', {}))
+                    self.insert(doc)
+            elif ids:
+                data = {k: v for k, v in document.iteritems() if k != '_id'}
+                conn.execute('UPDATE %s SET doc = ? WHERE _id = ?' % self.table,
+                             (dumps(data), ids[0]))
+            elif upsert:
+                self.insert(dict(document))
+
+    def find_and_modify(self, query=None, update=None, sort=None, new=False):
+        """
+        Atomically update the first document matching the query (in the sort
+        order) and return it, as it was before the update or, if `new`, after
+        it. Returns None if no document matches
+        """
+        with self.storage.transaction() as conn:
+            doc = self.find_one(query, sort=sort)
+            if doc is None:
+                return None
+            self.apply_update(conn, doc['_id'], update)
+            if new:
+                doc = self.find_one({'_id': doc['_id']})
+            return doc
+
+    def apply_update(self, conn, _id, document):
+        unknown = set(document) - {'$set', '$unset', '$inc'}
+        if unknown:
+            raise ValueError('Unsupported update operators: %s' % ', '.join(unknown))
+        expr = 'doc'
+        params = []
+        paths = []
+        for k, v in (document.get('$set') or {}).iteritems():
+            field_expr(k)
+            paths.append("'$.%s', json(?)" % k)
+            params.append(dumps(v))
+        for k, v in (document.get('$inc') or {}).iteritems():
+            paths.append("'$.%s', COALESCE(%s, 0) + ?" % (k, field_expr(k)))
+            params.append(v)
+        if paths:
+            expr = 'json_set(%s, %s)' % (expr, ', '.join(paths))
+        unset_fields = document.get('$unset') or {}
+        if unset_fields:
+            for k in unset_fields:
+                field_expr(k)
+            expr = 'json_remove(%s, %s)' % (expr, ', '.join("'$.%s'" % k for k in unset_fields))
+        params.append(_id)
+        conn.execute('UPDATE %s SET doc = %s WHERE _id = ?' % (self.table, expr), params)
+
+    def remove(self, spec=None):
+        where, params = self.where(spec)
+        with self.storage.transaction() as conn:
+            conn.execute('DELETE FROM %s %s' % (self.table, where), params)
+
+    def ensure_index(self, keys, unique=False, name=None):
+        if isinstance(keys, basestring):
+            keys = [(keys, 1)]
+        name = name or '_'.join('%s_%s' % key for key in keys)
+        columns = ', '.join('%s %s' % (field_expr(k), 'DESC' if d < 0 else 'ASC') for k, d in keys)
+        self.storage.execute('CREATE %s INDEX IF NOT EXISTS "%s_%s" ON %s (%s)' % (
+            'UNIQUE' if unique else '', self.name, name, self.table, columns))
+
+    def initialize_unordered_bulk_op(self):
+        return SqliteBulkOperation(self)
+
+
+class SqliteCursor(object):
+    """
+    Lazy query result, fetched by pages with the keyset pagination on the
+    sort keys. Projected fields are extracted by SQLite, so the other fields
+    of the documents (e.g. revision texts) are not decoded
+    """
+
+    def __init__(self, collection, spec, fields):
+        self.collection = collection
+        self.spec = spec or {}
+        self.fields = fields
+        self.order = [('_id', 1)]
+        self.max_count = None
+
+    def sort(self, key_or_list, direction=1):
+        if isinstance(key_or_list, basestring):
+            key_or_list = [(key_or_list, direction)]
+        self.order = list(key_or_list)
+        return self
+
+    def limit(self, max_count):
+        self.max_count = max_count
+        return self
+
+    def count(self):
+        where, params = self.collection.where(self.spec)
+        sql = 'SELECT COUNT(*) FROM %s %s' % (self.collection.table, where)
+        return self.collection.storage.execute(sql, params)[0][0]
+
+    def distinct(self, key):
+        where, params = self.collection.where(self.spec)
+        sql = 'SELECT DISTINCT %s FROM %s %s' % (field_expr(key), self.collection.table, where)
+        return [row[0] for row in self.collection.storage.execute(sql, params) if row[0] is not None]
+
+    def __iter__(self):
+        for row in self.iter_pages():
+            doc = loads(row[1])
+            doc['_id'] = row[0]
+            yield doc
+
+    def iter_pages(self):
+        """
+        Iterate by pages with the keyset pagination, so that memory is bounded
+        by the page size in any sort order, and the collection can be modified
+        while iterating. Rows are (_id, document, values of the sort keys)
+        """
+        order = list(self.order)
+        if '_id' not in [k for k, _ in order]:
+            # unique last key, so that every row is after the previous page
+            order.append(('_id', 1))
+        last_keys = None
+        remaining = self.max_count
+        while remaining is None or remaining > 0:
+            page_size = self.collection.page_size
+            if remaining is not None:
+                page_size = min(page_size, remaining)
+                remaining -= page_size
+            rows = self.fetch(order, page_size, after=last_keys)
+            for row in rows:
+                yield row
+            if len(rows) < page_size:
+                break
+            last_keys = rows[-1][2:]
+
+    def fetch(self, order, limit, after=None):
+        where, params = self.collection.where(self.spec)
+        if after is not None:
+            clause, after_params = keyset_clause(order, after)
+            where += (' AND ' if where else 'WHERE ') + clause
+            params.extend(after_params)
+        keys = ', '.join(field_expr(k) for k, _ in order)
+        order_by = ', '.join('%s %s' % (field_expr(k), 'DESC' if d < 0 else 'ASC') for k, d in order)
+        sql = 'SELECT _id, %s, %s FROM %s %s ORDER BY %s LIMIT %d' % (
+            self.doc_expr(), keys, self.collection.table, where, order_by, limit)
+        return self.collection.storage.execute(sql, params)
+
+    def doc_expr(self):
+        """
+        SQL expression of the document with the projected fields only
+        """
+        if self.fields is None:
+            return 'doc'
+        fields = sorted(set(self.fields) - {'_id'})
+        for k in fields:
+            field_expr(k)
+        return ("(SELECT json_group_object(key, value) FROM json_each(doc) WHERE key IN (%s))" %
+                ', '.join("'%s'" % k for k in fields))
+
+
+def keyset_clause(order, values):
+    """
+    Translate the values of the sort keys of the last fetched row to the tuple
+    (SQL condition selecting the rows after it, params). SQLite sorts NULL
+    before any value
+    """
+    alternatives = []
+    params = []
+    for i, ((k, direction), value) in enumerate(zip(order, values)):
+        expr = field_expr(k)
+        if value is None:
+            if direction < 0:
+                # nothing sorts after NULL in descending order
+                continue
+            after, after_params = '%s IS NOT NULL' % expr, []
+        elif direction < 0:
+            after, after_params = '(%s < ? OR %s IS NULL)' % (expr, expr), [value]
+        else:
+            after, after_params = '%s > ?' % expr, [value]
+        equal = ['%s IS ?' % field_expr(key) for key, _ in order[:i]]
+        alternatives.append(' AND '.join(equal + [after]))
+        params.extend(list(values[:i]) + after_params)
+    clause = '(%s)' % ' OR '.join(alternatives)
+    k, direction = order[0]
+    if values[0] is not None:
+        # range of the first key, so that the index is used
+        expr = field_expr(k)
+        if direction < 0:
+            clause = '(%s <= ? OR %s IS NULL) AND %s' % (expr, expr, clause)
+        else:
+            clause = '%s >= ? AND %s' % (expr, clause)
+        params.insert(0, values[0])
+    return clause, params
+
+
+class SqliteBulkOperation(object):
+    """
+    Bulk write builder, executing all operations in a single transaction
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.ops = []
+
+    def find(self, spec):
+        return SqliteBulkSelector(self, spec)
+
+    def execute(self):
+        with self.collection.storage.transaction():
+            for spec, document, upsert in self.ops:
+                self.collection.update(spec, document, upsert=upsert)
+        self.ops = []
+
+
+class SqliteBulkSelector(object):
+
+    def __init__(self, bulk, spec, upsert=False):
+        self.bulk = bulk
+        self.spec = spec
+        self.is_upsert = upsert
+
+    def upsert(self):
+        return SqliteBulkSelector(self.bulk, self.spec, upsert=True)
+
+    def update_one(self, document):
+        self.bulk.ops.append((self.spec, document, self.is_upsert))
+
+    def replace_one(self, document):
+        self.bulk.ops.append((self.spec, document, self.is_upsert))
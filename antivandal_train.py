@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+"""
+Chunked training and evaluation of the vandalism classifier.
+
+The model is trained on train.csv and scored on test.csv against
+solution.csv (see `antivandal_export.split_dataset_streaming`), with the
+features of the edits taken from the feature matrix saved by
+`antivandal_export.export_features`::
+
+    python antivandal_train.py --features features --epochs 2 --output train.json
+
+Nothing is loaded as a whole: the tables are read in chunks, the features of
+every chunk are selected by (ds, editid) from the memory-mapped matrix, the
+model is trained incrementally with `partial_fit` and the metrics are
+accumulated chunk by chunk (see `StreamingMetrics`). So memory is bounded by
+the chunk size, whatever the size of the corpus and the number of features.
+The tables must have the "ds" column, exported since it was added to
+`antivandal_export.base_fields`.
+
+Every phase (fitting the scaler, training epochs, prediction, evaluation) is
+reported with its throughput and peak memory (peak resident set size, which
+includes the pages of the memory-mapped features, reclaimable by the OS).
+"""
+from __future__ import division
+import time
+import pickle
+import argparse
+from itertools import izip_longest
+from collections import OrderedDict
+from contextlib import contextmanager
+from antivandal import (LazyModule, get_memory_usage, reset_peak_memory, print_results,
+                        save_results)
+from antivandal_export import read_table_chunks, load_features, select_rows
+
+np = LazyModule('numpy')
+pd = LazyModule('pandas')
+sparse = LazyModule('scipy.sparse')
+linear_model = LazyModule('sklearn.linear_model')
+preprocessing = LazyModule('sklearn.preprocessing')
+
+
+#--- Model
+
+class StreamingModel(object):
+    """
+    Incremental classifier on the feature matrix: hashed tokens as is, and
+    dense features standardized (missing values are 0 before scaling).
+
+    :param estimator: classifier with `partial_fit` and `predict_proba`
+                      methods, logistic regression trained with SGD by default
+    """
+
+    classes = [False, True]
+
+    def __init__(self, estimator=None, alpha=1e-4, seed=1234):
+        self.estimator = estimator or linear_model.SGDClassifier(loss='log', alpha=alpha,
+                                                                 random_state=seed)
+        self.scaler = preprocessing.StandardScaler()
+        self.dense_columns = None
+        self.random_state = np.random.RandomState(seed)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, 'rb') as f:
+            data = pickle.load(f)
+        model = cls(data['estimator'])
+        model.scaler = data['scaler']
+        model.dense_columns = data['dense_columns']
+        return model
+
+    def save(self, filename):
+        data = {'estimator': self.estimator,
+                'scaler': self.scaler,
+                'dense_columns': self.dense_columns}
+        with open(filename, 'wb') as f:
+            pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+
+    def check_columns(self, rows):
+        if self.dense_columns is None:
+            self.dense_columns = list(rows['dense_columns'])
+        elif self.dense_columns != list(rows['dense_columns']):
+            raise ValueError('Features have different dense columns than the model')
+
+    def partial_fit_scaler(self, rows):
+        self.check_columns(rows)
+        self.scaler.partial_fit(np.nan_to_num(rows['dense']))
+
+    def get_matrix(self, rows):
+        self.check_columns(rows)
+        dense = self.scaler.transform(np.nan_to_num(rows['dense']))
+        return sparse.hstack([rows['tokens'], sparse.csr_matrix(dense)], format='csr')
+
+    def partial_fit(self, rows, y):
+        """
+        Train on the chunk of rows (see `antivandal_export.select_rows`),
+        shuffled
+        """
+        X = self.get_matrix(rows)
+        order = self.random_state.permutation(X.shape[0])
+        self.estimator.partial_fit(X[order], np.asarray(y, dtype=bool)[order], classes=self.classes)
+
+    def predict_proba(self, rows):
+        return self.estimator.predict_proba(self.get_matrix(rows))[:, 1]
+
+
+#--- Streaming metrics
+
+class StreamingMetrics(object):
+    """
+    Metrics of the binary classifier accumulated chunk by chunk in constant
+    memory.
+
+    Scores (probabilities in [0, 1]) are counted in `bins` equal-width bins
+    per class, so AUC-PR (average precision) and ROC AUC are exact for the
+    scores rounded down to the multiple of 1 / bins. Precision, recall and F1
+    are computed at `threshold`
+    """
+
+    def __init__(self, bins=1 << 16, threshold=0.5):
+        self.bins = bins
+        self.threshold = threshold
+        self.positives = np.zeros(bins, dtype=np.int64)
+        self.negatives = np.zeros(bins, dtype=np.int64)
+        self.log_loss_sum = 0.0
+        self.true_positives = 0
+        self.false_positives = 0
+
+    def update(self, y_true, scores):
+        y = np.asarray(y_true, dtype=bool)
+        scores = np.clip(np.asarray(scores, dtype=np.float64), 0, 1)
+        bins = np.minimum((scores * self.bins).astype(np.int64), self.bins - 1)
+        self.positives += np.bincount(bins[y], minlength=self.bins)
+        self.negatives += np.bincount(bins[~y], minlength=self.bins)
+        p = np.clip(scores, 1e-15, 1 - 1e-15)
+        self.log_loss_sum -= np.log(p[y]).sum() + np.log(1 - p[~y]).sum()
+        predicted = scores >= self.threshold
+        self.true_positives += int((predicted & y).sum())
+        self.false_positives += int((predicted & ~y).sum())
+
+    def get_curve(self):
+        """
+        Return (true positives, false positives) arrays at every threshold,
+        from the highest score down
+        """
+        positives = self.positives[::-1]
+        negatives = self.negatives[::-1]
+        used = (positives + negatives) > 0
+        return np.cumsum(positives)[used], np.cumsum(negatives)[used]
+
+    def average_precision(self):
+        tp, fp = self.get_curve()
+        if not len(tp) or tp[-1] == 0:
+            return float('nan')
+        precision = tp / (tp + fp)
+        recall = tp / tp[-1]
+        return float(np.sum(np.diff(np.concatenate([[0], recall])) * precision))
+
+    def roc_auc(self):
+        tp, fp = self.get_curve()
+        if not len(tp) or tp[-1] == 0 or fp[-1] == 0:
+            return float('nan')
+        tpr = np.concatenate([[0], tp / tp[-1]])
+        fpr = np.concatenate([[0], fp / fp[-1]])
+        return float(np.trapz(tpr, fpr))
+
+    def get_results(self):
+        positives = int(self.positives.sum())
+        rows = positives + int(self.negatives.sum())
+        predicted = self.true_positives + self.false_positives
+        precision = self.true_positives / predicted if predicted else float('nan')
+        recall = self.true_positives / positives if positives else float('nan')
+        f1 = 2 * self.true_positives / (predicted + positives) if predicted + positives else float('nan')
+        return OrderedDict([('rows', rows),
+                            ('positives', positives),
+                            ('pr_auc', self.average_precision()),
+                            ('roc_auc', self.roc_auc()),
+                            ('log_loss', self.log_loss_sum / rows if rows else float('nan')),
+                            ('precision', precision),
+                            ('recall', recall),
+                            ('f1', f1)])
+
+
+#--- Phases
+
+@contextmanager
+def measure_phase(results, name):
+    """
+    Measure the phase: the body adds the number of processed rows to
+    counter['rows'] of the yielded counter
+    """
+    reset_peak_memory()
+    rss, _ = get_memory_usage()
+    start = time.time()
+    counter = {'rows': 0}
+    yield counter
+    elapsed = time.time() - start
+    peak = get_memory_usage()[1]
+    results[name] = OrderedDict([('rows', counter['rows']),
+                                 ('seconds', elapsed),
+                                 ('rows_per_second', counter['rows'] / elapsed if elapsed else 0),
+                                 ('peak_memory_mb', peak),
+                                 ('memory_growth_mb', peak - rss)])
+
+
+def iter_table_chunks(filename, chunk_size, columns):
+    for chunk in read_table_chunks(filename, chunk_size, columns=columns):
+        yield [chunk[column].values for column in columns]
+
+
+def train(model, features, filename='train.csv', chunk_size=10000, epochs=1, results=None):
+    """
+    Fit the scaler of dense features in one pass over the train table, then
+    train the model for `epochs` passes
+    """
+    results = OrderedDict() if results is None else results
+    with measure_phase(results, 'scale') as counter:
+        for ds, editids in iter_table_chunks(filename, chunk_size, ['ds', 'editid']):
+            model.partial_fit_scaler(select_rows(features, editids, ds))
+            counter['rows'] += len(editids)
+    for epoch in xrange(epochs):
+        with measure_phase(results, 'train_%d' % (epoch + 1)) as counter:
+            for ds, editids, y in iter_table_chunks(filename, chunk_size, ['ds', 'editid', 'vandalism']):
+                model.partial_fit(select_rows(features, editids, ds), y)
+                counter['rows'] += len(editids)
+    return results
+
+
+def predict(model, features, filename='test.csv', output='predictions.csv', chunk_size=10000,
+            results=None):
+    """
+    Score the edits of the table and write (ds, editid, score) rows to
+    `output`
+    """
+    results = OrderedDict() if results is None else results
+    with measure_phase(results, 'predict') as counter, open(output, 'w') as f:
+        header = True
+        for ds, editids in iter_table_chunks(filename, chunk_size, ['ds', 'editid']):
+            scores = model.predict_proba(select_rows(features, editids, ds))
+            pd.DataFrame({'ds': ds, 'editid': editids, 'score': scores}).to_csv(
+                f, index=False, header=header, columns=['ds', 'editid', 'score'])
+            header = False
+            counter['rows'] += len(editids)
+    return results
+
+
+def evaluate(predictions='predictions.csv', solution='solution.csv', chunk_size=10000,
+             results=None):
+    """
+    Score the predictions against the solution, both read in chunks. Rows of
+    both tables must be in the same order. Return StreamingMetrics
+    """
+    results = OrderedDict() if results is None else results
+    metrics = StreamingMetrics()
+    with measure_phase(results, 'evaluate') as counter:
+        predicted_chunks = iter_table_chunks(predictions, chunk_size, ['ds', 'editid', 'score'])
+        solution_chunks = iter_table_chunks(solution, chunk_size, ['ds', 'editid', 'vandalism'])
+        for predicted, expected in izip_longest(predicted_chunks, solution_chunks):
+            if (predicted is None or expected is None or
+                    not np.array_equal(predicted[0], expected[0]) or
+                    not np.array_equal(predicted[1], expected[1])):
+                raise ValueError('Rows of %s and %s are not aligned' % (predictions, solution))
+            metrics.update(expected[2], predicted[2])
+            counter['rows'] += len(expected[1])
+    return metrics
+
+
+def run(features='features', train_filename='train.csv', test_filename='test.csv',
+        solution_filename='solution.csv', predictions='predictions.csv', model_filename=None,
+        chunk_size=10000, epochs=1, alpha=1e-4):
+    """
+    Train, predict and evaluate. Return the OrderedDict of phase stats, and
+    the metrics (with the overall peak memory) as "metrics"
+    """
+    features = load_features(features)
+    model = StreamingModel(alpha=alpha)
+    results = train(model, features, train_filename, chunk_size, epochs)
+    if model_filename:
+        model.save(model_filename)
+    predict(model, features, test_filename, predictions, chunk_size, results)
+    metrics = evaluate(predictions, solution_filename, chunk_size, results).get_results()
+    metrics['peak_memory_mb'] = max(result['peak_memory_mb'] for result in results.values())
+    results['metrics'] = metrics
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--features', default='features', help='directory of export_features')
+    parser.add_argument('--train', default='train.csv')
+    parser.add_argument('--test', default='test.csv')
+    parser.add_argument('--solution', default='solution.csv')
+    parser.add_argument('--predictions', default='predictions.csv')
+    parser.add_argument('--model', help='save the trained model to this file')
+    parser.add_argument('--chunk-size', type=int, default=10000)
+    parser.add_argument('--epochs', type=int, default=1)
+    parser.add_argument('--alpha', type=float, default=1e-4, help='regularization of SGD')
+    parser.add_argument('--output', help='save results to this JSON file')
+    args = parser.parse_args(argv)
+
+    results = run(args.features, args.train, args.test, args.solution, args.predictions,
+                  args.model, args.chunk_size, args.epochs, args.alpha)
+    print_results(results)
+    if args.output:
+        save_results(args.output, 'train', results)
+
+
+if __name__ == '__main__':
+    main()